@@ -0,0 +1,178 @@
+"""
+Indexed store of the backers listed in users.csv.
+
+The store is an SQLite database next to the csv file. It only gets rebuilt when the size
+or the modification time of users.csv changes, so lookups don't parse the csv file again.
+Emails and coupons have case-insensitive indexes, and an FTS5 table indexes the
+emails and names for word and prefix searches.
+"""
+import os
+import csv
+import sqlite3
+from collections import namedtuple
+
+
+USERS_FILE = 'users.csv'
+DATABASE_FILE = 'users.sqlite'
+USER_FIELDS = ['email', 'first_name', 'last_name', 'pledge_name', 'pledge_amount', 'coupon']
+# SQLite limits the number of parameters in a query
+MAX_QUERY_PARAMETERS = 500
+
+Backer = namedtuple('Backer', USER_FIELDS)
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE backers (
+    id INTEGER PRIMARY KEY,
+    email TEXT COLLATE NOCASE,
+    first_name TEXT,
+    last_name TEXT,
+    pledge_name TEXT,
+    pledge_amount TEXT,
+    coupon TEXT COLLATE NOCASE
+);
+CREATE INDEX backers_email ON backers (email);
+CREATE INDEX backers_coupon ON backers (coupon);
+CREATE VIRTUAL TABLE backers_search USING fts5(
+    email, first_name, last_name, content='backers', content_rowid='id', prefix='2 3'
+);
+"""
+
+
+def get_csv_file_as_dict(path, skip_first_row=False, header_fields=USER_FIELDS):
+    """
+    Opens a csv file and returns its content as a list of dicts, one per row,
+    with the header_fields as keys
+
+    Optionally skips the header
+    """
+    with open(path, mode='r', encoding='utf-8', newline='') as data:
+        reader = csv.DictReader(data, fieldnames=header_fields)
+        if skip_first_row:
+            next(reader, None)
+        return [line for line in reader]
+
+
+def get_csv_stamp(path):
+    stat = os.stat(path)
+    return '{!s}:{!s}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def build_database(csv_path, db_path):
+    """
+    Writes the backers from the csv file to a new database at db_path.tmp
+    then replaces db_path with it, so other running lookups keep a complete database
+    """
+    temp_path = db_path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    stamp = get_csv_stamp(csv_path)
+    users = get_csv_file_as_dict(csv_path, skip_first_row=True)
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.executemany(
+                'INSERT INTO backers (email, first_name, last_name, pledge_name, pledge_amount, coupon) VALUES (?, ?, ?, ?, ?, ?)',
+                ([(user[field] or '').strip() for field in USER_FIELDS] for user in users))
+            connection.execute("INSERT INTO backers_search (backers_search) VALUES ('rebuild')")
+            connection.execute("INSERT INTO meta (key, value) VALUES ('csv_stamp', ?)", (stamp,))
+    finally:
+        connection.close()
+    os.replace(temp_path, db_path)
+
+
+def make_search_query(text):
+    """
+    Turns free text into an FTS5 query that matches rows containing
+    every word of the text, as a whole word or a word prefix
+    """
+    words = text.replace('"', ' ').split()
+    return ' '.join('"{!s}"*'.format(word) for word in words)
+
+
+class BackerStore:
+    """
+    Answers backer queries by email, coupon and name from the SQLite database
+    Use open_store() to get a store that is up to date with the csv file
+    """
+
+    def __init__(self, db_path=DATABASE_FILE):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+
+    def get_stamp(self):
+        try:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'csv_stamp'").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        return row[0] if row else None
+
+    def _select(self, where, parameters=()):
+        query = 'SELECT email, first_name, last_name, pledge_name, pledge_amount, coupon FROM backers ' + where
+        return [Backer(*row) for row in self.connection.execute(query, parameters)]
+
+    def find_by_email(self, email):
+        """Returns the Backer with this email, ignoring case, or None"""
+        if not email.strip():
+            return None
+        backers = self._select('WHERE email = ? LIMIT 1', (email.strip(),))
+        return backers[0] if backers else None
+
+    def find_by_coupon(self, coupon):
+        """Returns the Backer with this coupon code, ignoring case, or None"""
+        backers = self._select('WHERE coupon = ? LIMIT 1', (coupon.strip(),))
+        return backers[0] if backers else None
+
+    def find_by_emails(self, emails):
+        """
+        Looks up a list of emails with one query per chunk of MAX_QUERY_PARAMETERS emails
+        Returns a dict of lowercase email: Backer, without the emails that aren't in the store
+        """
+        emails = list(set(email.strip().lower() for email in emails if email.strip()))
+        found = {}
+        for start in range(0, len(emails), MAX_QUERY_PARAMETERS):
+            chunk = emails[start:start + MAX_QUERY_PARAMETERS]
+            where = 'WHERE email IN ({!s})'.format(', '.join('?' * len(chunk)))
+            for backer in self._select(where, chunk):
+                found[backer.email.lower()] = backer
+        return found
+
+    def search(self, text, limit=10):
+        """
+        Returns up to limit backers whose email or names contain every word of text,
+        as a whole word or a prefix, best matches first
+        """
+        query = make_search_query(text)
+        if not query:
+            return []
+        where = ('JOIN (SELECT rowid, rank FROM backers_search WHERE backers_search MATCH ? ORDER BY rank LIMIT ?) AS matches '
+                 'ON backers.id = matches.rowid ORDER BY matches.rank')
+        return self._select(where, (query, limit))
+
+    def get_all(self):
+        return self._select('ORDER BY id')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_store(csv_path=USERS_FILE, db_path=DATABASE_FILE):
+    """
+    Returns a BackerStore for the csv file
+    Rebuilds the database first if it's missing or if the csv file changed since the last build
+    """
+    if os.path.exists(db_path):
+        store = BackerStore(db_path)
+        if store.get_stamp() == get_csv_stamp(csv_path):
+            return store
+        store.close()
+    build_database(csv_path, db_path)
+    return BackerStore(db_path)
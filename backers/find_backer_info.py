@@ -1,7 +1,28 @@
-import subprocess
+"""
+Finds a backer's coupon code and prints the coupon links for their pledge.
+
+Without options, search the backers interactively by email or name, and pick one of the best matches:
+`python find_backer_info.py`
+
+Print the coupon links of the best fuzzy match, without prompting, e.g. from support tools:
+`python find_backer_info.py --query 'jhn smth'`
+
+Look a backer up by email, coupon code, or name:
+`python find_backer_info.py --email backer@example.com`
+`python find_backer_info.py --coupon KS2018-XXXX`
+`python find_backer_info.py --name 'first last'`
+
+Look up every email in a text file, one email per line:
+`python find_backer_info.py --batch emails.txt`
+
+The backers get loaded from users.csv into an indexed database, users.sqlite,
+that the script rebuilds when users.csv changes.
+"""
 import sys
-import csv
-import logging
+import argparse
+
+from backer_store import open_store, USERS_FILE, DATABASE_FILE
+from fuzzy_match import FuzzyIndex
 
 
 product_urls = {
@@ -15,46 +36,97 @@ product_urls = {
     'hobby': 'https://gum.co/vmPA'
 
 }
+PREMIUM_PLEDGES = ['Premium', 'Craftsman\'s bundle', '1 on 1 review', 'Your own tutorial', 'Sponsor']
+
 
-def get_csv_file_as_dict(path, skip_first_row=False, header_fields = []):
+def get_coupon_urls(backer):
     """
-    Opens a csv file and returns its content as a list,
-    one list element entry per row (tuple or individual value)
+    Returns the list of product urls with the backer's coupon code, based on their pledge
+    """
+    if backer.pledge_name in PREMIUM_PLEDGES:
+        urls = product_urls['premium']
+    elif backer.pledge_name == 'Pro':
+        urls = [product_urls['indie']]
+    elif backer.pledge_name == 'Essentials':
+        urls = [product_urls['hobby']]
+    else:
+        urls = []
+    return [url + '/' + backer.coupon for url in urls]
+
 
-    Optionally skips the header
+def print_backer_info(backer):
+    print('{!s} {!s}\'s coupon code is {!s}'.format(backer.first_name, backer.last_name, backer.coupon))
+    print('\n')
+    for url in get_coupon_urls(backer):
+        print(url)
+    print('\n')
+
+
+def pick_backer_interactively(index, limit=10):
+    """
+    Prompts for a search query and lists the best matches until the user picks a backer
+    Returns None if the user enters an empty query
     """
-    with open(path, mode='r', encoding='utf-8') as data:
-        if not header_fields:
-            logging.warning('header_fields is an empty list. Using the csv file\'s first row as header.')
-        reader = csv.DictReader(data, fieldnames=header_fields)
-        if skip_first_row:
-            next(reader)
-        content = [line for line in reader]
-        return content
-    print('Could not open the CSV file')
-    return
-
-
-users_list = get_csv_file_as_dict('users.csv', skip_first_row=True, header_fields=['email', 'first_name', 'last_name', 'pledge_name',  'pledge_amount', 'coupon'])
-emails_list = [user['email'] for user in users_list]
-
-out = None
-with open('temp.csv', 'w') as f:
-    f.writelines([l + '\n' for l in emails_list])
-with open('temp.csv', 'r') as f:
-    out = subprocess.run('fzf', stdin = f, stdout = subprocess.PIPE)
-
-search_result = out.stdout.decode('utf8').replace('\n', '')
-for user in users_list:
-    if user['email'] == search_result:
-        print('{!s} {!s}\'s coupon code is {!s}'.format(user['first_name'].strip(), user['last_name'].strip(), user['coupon']))
-        print('\n')
-        if user['pledge_name'] in ['Premium', 'Craftsman\'s bundle', '1 on 1 review', 'Your own tutorial', 'Sponsor']:
-            for url in product_urls['premium']:
-                print(url + '/' + user['coupon'])
-        elif user['pledge_name'] == 'Pro':
-            print(product_urls['indie'] + '/' + user['coupon'])
-        elif user['pledge_name'] == 'Essentials':
-            print(product_urls['hobby'] + '/' + user['coupon'])
-        break
-print('\n')
+    while True:
+        query = input('Search backers by email or name (leave empty to quit): ')
+        if not query.strip():
+            return None
+        matches = index.search(query, limit)
+        if not matches:
+            print('No match.')
+            continue
+        for number, backer in enumerate(matches, start=1):
+            print('{!s}. {!s} {!s} <{!s}>'.format(number, backer.first_name, backer.last_name, backer.email))
+        choice = input('Pick a number, or press enter to search again: ').strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(matches):
+            return matches[int(choice) - 1]
+
+
+def get_cli_arguments():
+    parser = argparse.ArgumentParser(description='Find a backer\'s coupon code and coupon links')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-e', '--email', type=str, default='', help='The email of the backer to find, ignoring case')
+    group.add_argument('-c', '--coupon', type=str, default='', help='The coupon code of the backer to find')
+    group.add_argument('-n', '--name', type=str, default='', help='Words or word starts from the backer\'s names or email, e.g. "john sm"')
+    group.add_argument('-q', '--query', type=str, default='', help='Fuzzy search on the emails and names, e.g. "jhn smth". Prints the best match without prompting')
+    group.add_argument('-b', '--batch', type=str, default='', help='Text file with one email per line, to look up all at once')
+    parser.add_argument('-k', '--top', type=int, default=1, help='With --query, the number of best matches to print. Default: 1')
+    parser.add_argument('--csv', type=str, default=USERS_FILE, help='The csv file that lists the backers. Default: {!s}'.format(USERS_FILE))
+    parser.add_argument('--database', type=str, default=DATABASE_FILE, help='The index built from the csv file. Default: {!s}'.format(DATABASE_FILE))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_cli_arguments()
+    with open_store(args.csv, args.database) as store:
+        if args.batch:
+            with open(args.batch, 'r', encoding='utf-8') as emails_file:
+                emails = [line.strip() for line in emails_file if line.strip()]
+            found = store.find_by_emails(emails)
+            for email in emails:
+                backer = found.get(email.lower())
+                if backer:
+                    print('{!s}: {!s}'.format(email, backer.coupon))
+                    for url in get_coupon_urls(backer):
+                        print('    ' + url)
+                else:
+                    print('{!s}: not found'.format(email))
+            sys.exit()
+
+        if args.name:
+            backers = store.search(args.name)
+        elif args.coupon:
+            backers = [store.find_by_coupon(args.coupon)]
+        elif args.email:
+            backers = [store.find_by_email(args.email)]
+        elif args.query:
+            backers = FuzzyIndex(store.get_all()).search(args.query, args.top)
+        else:
+            backers = [pick_backer_interactively(FuzzyIndex(store.get_all()))]
+
+        backers = [backer for backer in backers if backer]
+        if not backers:
+            print('Could not find the backer.')
+            sys.exit(1)
+        for backer in backers:
+            print_backer_info(backer)
@@ -0,0 +1,96 @@
+"""
+Ranked fuzzy search over the backers' emails and names, in the spirit of fzf.
+
+A query matches a text if its characters appear in the text in the same order.
+Matches score higher when the characters are consecutive, start words, or start the text.
+A query with several words only matches backers that match every word.
+"""
+import re
+import heapq
+
+
+SCORE_MATCH = 16
+BONUS_CONSECUTIVE = 8
+BONUS_WORD_START = 8
+BONUS_TEXT_START = 4
+PENALTY_GAP = 1
+MAX_GAP_PENALTY = 6
+WORD_SEPARATORS = ' .-_@+'
+
+
+def score_match(query, text):
+    """
+    Returns the score of the lowercase query against the lowercase text,
+    or None if the query's characters don't all appear in order in the text
+    Tries an exact substring first, then the leftmost subsequence
+    """
+    start = text.find(query)
+    if start != -1:
+        positions = range(start, start + len(query))
+    else:
+        positions = []
+        position = -1
+        for char in query:
+            position = text.find(char, position + 1)
+            if position == -1:
+                return None
+            positions.append(position)
+
+    score, previous = 0, None
+    for position in positions:
+        score += SCORE_MATCH
+        if position == 0:
+            score += BONUS_TEXT_START + BONUS_WORD_START
+        elif text[position - 1] in WORD_SEPARATORS:
+            score += BONUS_WORD_START
+        if previous is not None:
+            if position == previous + 1:
+                score += BONUS_CONSECUTIVE
+            else:
+                score -= min(position - previous - 1, MAX_GAP_PENALTY) * PENALTY_GAP
+        previous = position
+    return score
+
+
+class FuzzyIndex:
+    """
+    Precomputes the lowercase email and names of every backer once,
+    so each search only lowercases the query
+    """
+
+    def __init__(self, backers):
+        self.entries = []
+        for backer in backers:
+            first_name, last_name = backer.first_name.lower(), backer.last_name.lower()
+            fields = (backer.email.lower(), first_name, last_name, first_name + ' ' + last_name)
+            self.entries.append((backer, fields, '\n'.join(fields)))
+
+    def search(self, query, limit=10):
+        """
+        Returns up to limit backers matching every word of the query, best matches first
+        """
+        words = query.lower().split()
+        if not words:
+            return []
+        # The regular expressions discard most backers at C speed before the scoring
+        patterns = [re.compile('[^\n]*?'.join(re.escape(char) for char in word)) for word in words]
+
+        scored = []
+        for index, (backer, fields, haystack) in enumerate(self.entries):
+            if not all(pattern.search(haystack) for pattern in patterns):
+                continue
+            total = 0
+            for word in words:
+                scores = [score for score in (score_match(word, field) for field in fields) if score is not None]
+                if not scores:
+                    break
+                total += max(scores)
+            else:
+                # Shorter emails rank first among equal scores, then the csv order
+                scored.append((total, -len(fields[0]), -index, backer))
+        return [entry[3] for entry in heapq.nlargest(limit, scored)]
+
+    def best_match(self, query):
+        """Returns the best matching backer or None"""
+        matches = self.search(query, limit=1)
+        return matches[0] if matches else None
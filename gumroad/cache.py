@@ -0,0 +1,119 @@
+"""
+Local cache of Gumroad products and offer codes, and diff-based coupon sync.
+
+The cache is a JSON file that stores the products list and each product's offer codes
+with the time they were downloaded. Syncing compares the cached offer code names to
+the wanted names with set operations, then only sends the create and delete requests it needs.
+"""
+import os
+import json
+import time
+
+from defaults import DEFAULT_MAX_AGE
+
+
+CACHE_FILE = 'gumroad_cache.json'
+
+
+def normalize_coupon_name(name):
+    """Strips whitespace and the byte order mark csv files exported from Excel start with"""
+    return name.replace('\ufeff', '').strip()
+
+
+def diff_offer_codes(current_names, wanted_names):
+    """
+    Returns three sets of coupon names: to_create, to_delete, unchanged
+    """
+    current_names, wanted_names = set(current_names), set(wanted_names)
+    return wanted_names - current_names, current_names - wanted_names, current_names & wanted_names
+
+
+class OfferCodesCache:
+    """
+    Stores products and offer codes downloaded from Gumroad with their fetch timestamps
+    Entries older than max_age seconds get downloaded again
+    """
+
+    def __init__(self, path=CACHE_FILE, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.data = {'products': None, 'offer_codes': {}}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode='r', encoding='utf-8') as cache_file:
+            self.data = json.load(cache_file)
+
+    def save(self):
+        """Writes the cache to a temporary file then replaces the previous one"""
+        temp_path = self.path + '.tmp'
+        with open(temp_path, mode='w', encoding='utf-8') as cache_file:
+            json.dump(self.data, cache_file)
+        os.replace(temp_path, self.path)
+
+    def _is_fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched_at'] < self.max_age
+
+    def get_products(self, client, refresh=False):
+        """
+        Returns the list of product dicts, from the cache if it's fresh enough
+        Returns an empty list if the download failed, without caching it
+        """
+        entry = self.data['products']
+        if refresh or not self._is_fresh(entry):
+            products, _ = client.download_products_data()
+            if not products:
+                return []
+            entry = {'fetched_at': time.time(), 'items': products}
+            self.data['products'] = entry
+        return entry['items']
+
+    def get_offer_codes(self, client, product_id, refresh=False):
+        """
+        Returns the list of offer code dicts for the product, from the cache if it's fresh enough
+        Returns None if the download failed
+        """
+        entry = self.data['offer_codes'].get(product_id)
+        if refresh or not self._is_fresh(entry):
+            offer_codes = client.get_offer_codes(product_id)
+            if offer_codes is None:
+                return None
+            entry = {'fetched_at': time.time(), 'items': offer_codes}
+            self.data['offer_codes'][product_id] = entry
+        return entry['items']
+
+    def invalidate(self, product_id):
+        """Forces the next get_offer_codes call for the product to download the codes again"""
+        self.data['offer_codes'].pop(product_id, None)
+
+
+def sync_offer_codes(client, cache, product_id, wanted_names, amount_off=100, offer_type='percent', prune=False, journal=None, refresh=False):
+    """
+    Makes the product's offer codes match wanted_names: creates the missing codes and,
+    if prune is True, deletes the codes that aren't in wanted_names
+    Uses the cached offer codes unless refresh is True or the cache entry is too old
+    Returns a dict with the to_create, to_delete and unchanged sets and the lists of errors
+    """
+    offer_codes = cache.get_offer_codes(client, product_id, refresh)
+    if offer_codes is None:
+        return None
+    ids_by_name = {normalize_coupon_name(code['name']): code['id'] for code in offer_codes}
+    wanted_names = set(normalize_coupon_name(name) for name in wanted_names if normalize_coupon_name(name))
+    to_create, to_delete, unchanged = diff_offer_codes(ids_by_name.keys(), wanted_names)
+
+    report = {
+        'to_create': to_create,
+        'to_delete': to_delete,
+        'unchanged': unchanged,
+        'create_errors': [],
+        'delete_errors': [],
+    }
+    if to_create:
+        _, report['create_errors'] = client.batch_create_coupons(sorted(to_create), product_id, amount_off, offer_type, journal)
+    if prune and to_delete:
+        offer_code_ids = {name: ids_by_name[name] for name in to_delete}
+        _, report['delete_errors'] = client.batch_delete_coupons(offer_code_ids, product_id)
+    if to_create or (prune and to_delete):
+        cache.invalidate(product_id)
+    return report
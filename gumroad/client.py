@@ -0,0 +1,304 @@
+"""
+Gumroad API client shared by the gumroad scripts.
+
+Sends all requests through one requests.Session, so connections stay open between calls,
+and runs batches of requests on a pool of threads.
+A shared RateLimiter paces the requests and adapts to 429 and 5xx responses.
+Rate-limited requests are always retried, other failures only for idempotent methods.
+The requests package is only imported when a GumroadClient is created, so importing
+this module stays cheap for scripts that don't send any request.
+"""
+import sys
+import time
+import fnmatch
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from defaults import DEFAULT_CONCURRENCY
+from rate_limiter import RateLimiter, IDEMPOTENT_METHODS, DEFAULT_MAX_RETRIES, get_backoff_delay, parse_retry_after
+
+
+API_URL = 'https://api.gumroad.com/v2/'
+
+
+class GumroadError(Exception):
+    """Raised when the API doesn't return the requested data"""
+
+
+def print_progress(current, total, label='Progress'):
+    print("\r{!s}: {!s}/{!s}".format(label, current, total), end="", flush=True)
+    if current == total:
+        print()
+
+
+class GumroadClient:
+    """
+    Sends requests to the Gumroad API with the access_token
+    Up to `concurrency` requests run at the same time, sharing a pool of keep-alive connections
+    Change api_url to send the requests to another server, e.g. a local test server
+    """
+
+    def __init__(self, access_token, concurrency=DEFAULT_CONCURRENCY, api_url=API_URL, rate_limiter=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.access_token = access_token
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self.max_retries = max_retries
+        self.api_url = api_url
+        self.product_url = api_url + 'products/'
+        self.concurrency = max(concurrency, 1)
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        self._request_exception = requests.RequestException
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, data=None, idempotent=None):
+        """
+        Sends a request with the access token and returns the response
+        Waits for the rate limiter before each attempt
+        Retries 429 responses, and 5xx responses and connection errors if the request is idempotent,
+        up to max_retries times with a jittered exponential delay
+        Returns None if the request couldn't reach the server
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        data = dict(data) if data else {}
+        data['access_token'] = self.access_token
+
+        response = None
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                if method == 'GET':
+                    response = self.session.request(method, url, params=data)
+                else:
+                    response = self.session.request(method, url, data=data)
+            except self._request_exception as error:
+                response = None
+                if not idempotent or attempt == self.max_retries:
+                    print('Request to {!s} failed: {!s}'.format(url, error), file=sys.stderr)
+                    return None
+                time.sleep(get_backoff_delay(attempt))
+                continue
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            self.rate_limiter.on_response(response.status_code, retry_after)
+            if response.status_code == 429:
+                should_retry = True
+            else:
+                should_retry = idempotent and response.status_code >= 500
+            if not should_retry or attempt == self.max_retries:
+                break
+            time.sleep(max(retry_after or 0, get_backoff_delay(attempt)))
+        return response
+
+    def map_requests(self, method, requests_list, label='Progress', on_response=None):
+        """
+        Sends a list of (url, data) requests concurrently
+        Calls on_response(index, response) from the calling thread as each request completes
+        On errors or Ctrl+C, also calls it for the requests that were in flight and completed, before raising
+        Returns the list of responses, in the same order as requests_list
+        """
+        total = len(requests_list)
+        responses = [None] * total
+        if not total:
+            return responses
+        executor = ThreadPoolExecutor(max_workers=min(self.concurrency, total))
+        futures = {}
+        reported = set()
+        try:
+            for index, (url, data) in enumerate(requests_list):
+                futures[executor.submit(self.request, method, url, data)] = index
+            for count, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                responses[index] = future.result()
+                reported.add(index)
+                if on_response:
+                    on_response(index, responses[index])
+                print_progress(count, total, label)
+        finally:
+            # On errors or Ctrl+C, don't send the requests that are still waiting in the queue
+            executor.shutdown(wait=True, cancel_futures=True)
+            # The requests that were in flight went through, so the caller must know about them, e.g. to journal them
+            if on_response:
+                for future, index in futures.items():
+                    if index in reported or future.cancelled() or future.exception() is not None:
+                        continue
+                    responses[index] = future.result()
+                    on_response(index, responses[index])
+        return responses
+
+    def create_coupon_request(self, product_id, name, amount_off, offer_type='percent', max_purchase_count='1', universal='false'):
+        """
+        Returns a tuple of url(string), data(dict) ready to send a POST request to generate a new coupon code.
+        All passed args must be text strings.
+
+        Args:
+        - product_id, pass a valid Gumroad product id ()
+        - name, offer code's name and url slug
+        - amount_off, the amount off (in currency or percent, based on offer_type)
+        - offer_type, must be 'cent' or 'percent'
+        - max_purchase_count, max uses for this offer code
+        - universal, 'true' applies to all products, 'false only applies to the current product
+        """
+        url = self.product_url + product_id + '/offer_codes/'
+        data = {
+            'product_id': product_id,
+            'name': name,
+            'amount_off': amount_off,
+            'offer_type': offer_type,
+            'max_purchase_count': max_purchase_count,
+            'universal': universal
+        }
+        return (url, data)
+
+    def batch_create_coupons(self, codes_list, product_id, amount_off=100, offer_type='percent', journal=None):
+        """
+        Take a list of coupon codes and sends post requests to create them on the Gumroad API,
+        for the given product_id
+        If you pass a JobJournal, skips the codes it lists as created and records every result in it
+        as soon as it comes in
+        Returns two lists:
+        - created_codes, the coupons that were successfully created, including the ones skipped
+        - errors, a list of coupons that couldn't be created
+        """
+        from journal import JobStatus
+
+        codes_list = [code for code in codes_list if code != '']
+        created_codes, errors = [], []
+        if journal:
+            created_codes = [code for code in codes_list if journal.is_completed(product_id, code)]
+            codes_list = [code for code in codes_list if not journal.is_completed(product_id, code)]
+            if created_codes:
+                print('Skipping {!s} coupons already created for product {!s}'.format(len(created_codes), product_id))
+
+        def on_response(index, response):
+            code = codes_list[index]
+            status = JobStatus.CREATED if response is not None and response.ok else JobStatus.ERROR
+            if status is JobStatus.CREATED:
+                created_codes.append(code)
+            else:
+                errors.append(code)
+            if journal:
+                journal.record(product_id, code, status)
+
+        requests_list = [self.create_coupon_request(product_id, code, str(amount_off), offer_type) for code in codes_list]
+        self.map_requests('POST', requests_list, on_response=on_response)
+        return created_codes, errors
+
+    def batch_delete_coupons(self, offer_code_ids, product_id):
+        """
+        Sends delete requests for the product's offer codes
+        offer_code_ids is a dict of coupon name: offer code id
+        Returns two lists of coupon names: deleted_codes and errors
+        """
+        names = list(offer_code_ids.keys())
+        requests_list = [(self.product_url + product_id + '/offer_codes/' + offer_code_ids[name], None) for name in names]
+        responses = self.map_requests('DELETE', requests_list)
+
+        deleted_codes, errors = [], []
+        for name, response in zip(names, responses):
+            if response is not None and response.ok:
+                deleted_codes.append(name)
+            else:
+                errors.append(name)
+        return deleted_codes, errors
+
+    def iter_pages(self, url, params=None):
+        """
+        Sends GET requests to url and yields the JSON data of each page,
+        following next_page_url or next_page_key when the API paginates the results
+        Raises GumroadError if a request fails
+        """
+        params = dict(params) if params else {}
+        while url:
+            r = self.request('GET', url, params)
+            if r is None or not r.ok:
+                raise GumroadError('Could not download {!s}'.format(url))
+            data = r.json()
+            yield data
+
+            if data.get('next_page_url'):
+                url = urljoin(self.api_url, data['next_page_url'])
+                params = {}
+            elif data.get('next_page_key'):
+                params['page_key'] = data['next_page_key']
+            else:
+                url = None
+
+    def iter_products(self):
+        """
+        Yields the store's products one by one as pages come in
+        """
+        for page in self.iter_pages(self.api_url + 'products'):
+            for product in page['products']:
+                yield product
+
+    def iter_offer_codes(self, product_id):
+        """
+        Yields the product's offer codes one by one as pages come in
+        """
+        for page in self.iter_pages(self.product_url + product_id + '/offer_codes'):
+            for offer_code in page['offer_codes']:
+                yield offer_code
+
+    def get_offer_codes(self, product_id):
+        """
+        Returns the list of the product's offer codes as dicts, or None if the request failed
+        """
+        try:
+            return list(self.iter_offer_codes(product_id))
+        except GumroadError:
+            print('Could not download the offer codes of product {!s}'.format(product_id), file=sys.stderr)
+            return None
+
+    def find_offer_code_ids(self, product_id, names=None, pattern=None):
+        """
+        Downloads the product's offer codes once and returns a dict of coupon name: offer code id
+        for the coupons in the names list, or whose name matches the shell-style pattern, e.g. 'KS2018-*'
+        Returns None if the download failed
+        """
+        from cache import normalize_coupon_name
+
+        offer_codes = self.get_offer_codes(product_id)
+        if offer_codes is None:
+            return None
+        names = set(normalize_coupon_name(name) for name in names) if names else set()
+        offer_code_ids = {}
+        for offer_code in offer_codes:
+            name = normalize_coupon_name(offer_code['name'])
+            if name in names or (pattern and fnmatch.fnmatchcase(name, pattern)):
+                offer_code_ids[name] = offer_code['id']
+        return offer_code_ids
+
+    def recreate_coupon(self, product_id, coupon_code):
+        """
+        Deletes a coupon if it exists and re-creates it.
+        Use to re-create a coupon when a user didn't use it right or didn't
+        save the product in his Gumroad library
+        Returns the response to the POST request
+        """
+        offer_code_ids = self.find_offer_code_ids(product_id, [coupon_code]) or {}
+        if coupon_code in offer_code_ids:
+            self.request('DELETE', self.product_url + product_id + '/offer_codes/' + offer_code_ids[coupon_code])
+        url, data = self.create_coupon_request(product_id, coupon_code, '100')
+        return self.request('POST', url, data)
+
+    def download_products_data(self):
+        """
+        Returns a list of product dictionaries with the name, id and short_url keys and the total products count
+        """
+        products = []
+        try:
+            for p in self.iter_products():
+                products.append({
+                    'name': p['name'],
+                    'id': p['id'],
+                    'short_url': p['short_url']
+                })
+        except GumroadError:
+            print('Could not download the products list', file=sys.stderr)
+            return [], 0
+        return products, len(products)
@@ -0,0 +1,9 @@
+"""
+Default settings of the gumroad scripts.
+
+This module doesn't import anything, so the command line interface can read
+the defaults without loading the modules that send requests.
+"""
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_AGE = 600
+DEFAULT_RATE = 10.0
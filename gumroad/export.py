@@ -0,0 +1,110 @@
+"""
+Streams Gumroad products and offer codes to csv files.
+
+Rows get written as the API pages come in, to a temporary file that replaces
+the output file only once the download is complete.
+"""
+import os
+import csv
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from client import GumroadError
+
+
+OFFER_CODE_KEYS = ['product_id', 'id', 'name', 'amount_cents', 'percent_off', 'max_purchase_count', 'universal', 'times_used']
+
+
+def write_csv_atomically(path, header, rows):
+    """
+    Writes the header and the rows to path.tmp then renames it to path
+    If iterating over rows raises an exception, removes the temporary file and keeps the previous csv
+    Returns the number of rows written
+    """
+    temp_path = path + '.tmp'
+    count = 0
+    try:
+        with open(temp_path, 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.writer(csv_file, delimiter=',')
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return count
+
+
+def download_products_csv(client, path, keys):
+    """
+    Streams the store's products to a csv file with one column per key
+    Returns the number of products
+    """
+    rows = ([product.get(key, '') for key in keys] for product in client.iter_products())
+    return write_csv_atomically(path, keys, rows)
+
+
+def iter_offer_codes_concurrently(client, product_ids, max_queued_rows=1000):
+    """
+    Downloads the offer codes of several products at the same time, using the client's concurrency
+    Yields (product_id, offer_code) tuples as they come in, from the calling thread
+    The bounded queue makes the downloads wait if the consumer falls behind
+    Raises GumroadError once all downloads are over if any of them failed, whatever the error
+    """
+    rows = queue.Queue(maxsize=max_queued_rows)
+    done = object()
+    stop = threading.Event()
+    failed_product_ids = []
+
+    def put(item):
+        # Gives up if the consumer stopped iterating, so workers never block forever on a full queue
+        while not stop.is_set():
+            try:
+                rows.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def download(product_id):
+        try:
+            for offer_code in client.iter_offer_codes(product_id):
+                if not put((product_id, offer_code)):
+                    return
+        except Exception as error:
+            # Any error, e.g. an unexpected response, must fail the export rather than drop the product's codes
+            failed_product_ids.append((product_id, error))
+        finally:
+            put(done)
+
+    executor = ThreadPoolExecutor(max_workers=max(min(client.concurrency, len(product_ids)), 1))
+    try:
+        for product_id in product_ids:
+            executor.submit(download, product_id)
+        remaining = len(product_ids)
+        while remaining:
+            item = rows.get()
+            if item is done:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    if failed_product_ids:
+        raise GumroadError('Could not download the offer codes of products {!s}'.format(
+            ', '.join('{!s} ({!r})'.format(product_id, error) for product_id, error in failed_product_ids)))
+
+
+def download_offer_codes_csv(client, product_ids, path):
+    """
+    Streams the offer codes of the products to a csv file, one row per offer code
+    Returns the number of offer codes
+    """
+    rows = ([product_id] + [offer_code.get(key, '') for key in OFFER_CODE_KEYS[1:]]
+            for product_id, offer_code in iter_offer_codes_concurrently(client, product_ids))
+    return write_csv_atomically(path, OFFER_CODE_KEYS, rows)
@@ -3,7 +3,7 @@ Shell program to manage Gumroad products by sending http requests.
 
 Call the script with like `python gumroad.py mode gumroad_option -options`
 
-`mode` is one of three keywords: `get`, `post` and `delete`, to respectively download, create and delete data.
+`mode` is one of four keywords: `get`, `post`, `delete` and `sync`, to respectively download, create, delete data, and make Gumroad's data match a csv file.
 `gumroad_option` is the part of your shop you want to work on: currently `coupons` or `products`
 
 Access token:
@@ -12,24 +12,42 @@ You need an access token to connect with the Gumroad servers via the script. Eit
 `python gumroad.py get products --access-token 'your_access_token'`
 
 
+Download all offer codes of one or more products, or of every product in products.csv:
+`python gumroad.py get coupons -ids 'product name or id' --output coupons.csv`
+
+
 Batch-create coupon codes:
 `python gumroad.py post coupons --csv 'path/to/csv_file' -product 'name or id (partial works)'`
 
 
 Batch create coupon codes: python gumroad.py post coupons
+
+
+Batch delete coupon codes listed in a csv file, or whose name matches a pattern:
+`python gumroad.py delete coupons --csv 'path/to/csv_file' -ids 'product name or id'`
+`python gumroad.py delete coupons --pattern 'KS2018-*' -ids 'product name or id'`
+
+
+Sync coupon codes with a csv file, creating the missing ones:
+`python gumroad.py sync coupons --csv 'path/to/csv_file' -ids 'product name or id'`
+Add --prune to also delete the product's coupons that aren't in the csv file.
+The script caches the products and their coupons in gumroad_cache.json.
+
+
+You can also import the module and call its functions from another script:
+the products csv file is only read when a function needs it, and the modules that
+send http requests are only imported by the commands that use them.
 """
 import os
 import sys
 import csv
-import json
-import requests
-import time
 import argparse
+import functools
 from enum import Enum
 
 import logging
 
-PRODUCT_URL = 'https://api.gumroad.com/v2/products/'
+from defaults import DEFAULT_CONCURRENCY, DEFAULT_MAX_AGE, DEFAULT_RATE
 
 
 class Tiers(Enum):
@@ -38,8 +56,9 @@ class Tiers(Enum):
     PRO = 2
 
 PRODUCTS_FILE = 'products.csv'
-if not os.path.exists(PRODUCTS_FILE):
-    logging.warning('Missing products.csv file')
+JOURNAL_FILE = 'coupons_journal.csv'
+COUPONS_FILE = 'coupons.csv'
+ACCESS_TOKEN_FILE = 'access_token'
 
 
 class ProductKeys(Enum):
@@ -49,24 +68,12 @@ class ProductKeys(Enum):
 
 PRODUCT_KEYS = [member.value for member in ProductKeys]
 
-products = []
-with open(PRODUCTS_FILE) as csv_file:
-    reader = csv.reader(csv_file, delimiter=',')
-    header = next(reader)
-    for row in reader:
-        product = dict(zip(header, row))
-        products.append(product)
-
-print('Available products:', '\n')
-for p in products:
-    print("{!s}: {!s}".format(p[ProductKeys.NAME.value], p[ProductKeys.ID.value]))
-print('\n')
-
 
 class Modes(Enum):
     GET = 'get'
     POST = 'post'
     DELETE = 'delete'
+    SYNC = 'sync'
 
 
 class GumroadOptions(Enum):
@@ -77,7 +84,34 @@ class GumroadOptions(Enum):
 MODES = [member.value for member in Modes]
 GUMROAD_OPTIONS = [member.value for member in GumroadOptions]
 
-def get_cli_arguments():
+
+@functools.lru_cache(maxsize=None)
+def load_products(path=PRODUCTS_FILE):
+    """
+    Returns the list of product dicts stored in the products csv file
+    Reads the file on the first call only. Returns an empty list if the file doesn't exist
+    """
+    if not os.path.exists(path):
+        logging.warning('Missing {!s} file'.format(path))
+        return []
+    products = []
+    with open(path) as csv_file:
+        reader = csv.reader(csv_file, delimiter=',')
+        header = next(reader)
+        for row in reader:
+            product = dict(zip(header, row))
+            products.append(product)
+    return products
+
+
+def print_products(products):
+    print('Available products:', '\n')
+    for p in products:
+        print("{!s}: {!s}".format(p[ProductKeys.NAME.value], p[ProductKeys.ID.value]))
+    print('\n')
+
+
+def get_cli_arguments(argv=None):
     """
     Returns a tuple of args, mode, option.
     args is the raw list of arguments parsed by argparse
@@ -86,7 +120,7 @@ def get_cli_arguments():
     parser = argparse.ArgumentParser(description='Manage products and coupon codes on Gumroad')
 
     # Positional arguments
-    parser.add_argument('mode', choices=MODES, default=Modes.GET.value, help='Choose a mode between {!s}. Get retrieves and stores data from gumroad, post creates new entries and delete deletes them. Default: {!s}'.format(MODES, Modes.GET))
+    parser.add_argument('mode', choices=MODES, default=Modes.GET.value, help='Choose a mode between {!s}. Get retrieves and stores data from gumroad, post creates new entries, delete deletes them and sync creates and deletes entries to match the csv file. Default: {!s}'.format(MODES, Modes.GET))
     parser.add_argument('option', type=str, choices=GUMROAD_OPTIONS, default=GumroadOptions.COUPONS.value, help='Select what to edit or retrieve data from between {!s}. Default: {!s}'.format(GUMROAD_OPTIONS, GumroadOptions.COUPONS.value))
 
     # Options
@@ -94,75 +128,42 @@ def get_cli_arguments():
     parser.add_argument('-at', '--access_token', type=str, default='', help='Gumroad API access_token. You can find it in your account settings on gumroad.com')
     parser.add_argument('-cc', '--coupon_codes', nargs='+', help='One or more coupon codes to create. Separate them with spaces, e.g. coupon_one coupon_two')
     parser.add_argument('-ids', '--product_ids', nargs='+', help='The id or the name of the product you want to work on.')
+    parser.add_argument('-j', '--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of requests to send at the same time. Default: {!s}'.format(DEFAULT_CONCURRENCY))
+    parser.add_argument('-o', '--output', type=str, default='', help='In get mode, the csv file to write. Default: {!s} or {!s}'.format(PRODUCTS_FILE, COUPONS_FILE))
+    parser.add_argument('--journal', type=str, default=JOURNAL_FILE, help='File to record the created coupons in as the job runs. Default: {!s}'.format(JOURNAL_FILE))
+    parser.add_argument('--resume', action='store_true', help='Skip the coupons the journal lists as created by a previous run')
+    parser.add_argument('-p', '--pattern', type=str, default='', help='In delete mode, delete the coupons whose name matches this shell-style pattern, e.g. "KS2018-*"')
+    parser.add_argument('-y', '--yes', action='store_true', help='Delete coupons without asking for confirmation')
+    parser.add_argument('--prune', action='store_true', help='In sync mode, delete the coupons that are not in the csv file or --coupon_codes')
+    parser.add_argument('--refresh', action='store_true', help='Download the products and coupons again instead of using the cache')
+    parser.add_argument('--cache_max_age', type=int, default=DEFAULT_MAX_AGE, help='Seconds before cached coupons get downloaded again. Default: {!s}'.format(DEFAULT_MAX_AGE))
+    parser.add_argument('-r', '--rate', type=float, default=DEFAULT_RATE, help='Requests per second to start with. The script speeds up until the API asks it to slow down. Default: {!s}'.format(DEFAULT_RATE))
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-po', '--percent_off', type=int, default=100, help='Percentage to apply off the product when creating coupon codes')
     group.add_argument('-co', '--cents_off', type=int, default=0, help='Amount off the product list price in the currency\'s cents. E.g. a value of 500 means 5€/$ off')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     mode = [member for member in Modes if args.mode == member.value][0]
     option = [member for member in GumroadOptions if args.option == member.value][0]
 
     return args, mode, option
 
 
-def create_coupon_request(product_id, name, amount_off, offer_type='percent', max_purchase_count='1', universal='false'):
+def get_coupon_codes(args):
     """
-    Returns a tuple of url(string), data(dict) ready to send a POST request to generate a new coupon code and wraps it with the app's access token.
-    All passed args must be text strings.
-
-    Args:
-    - product_id, pass a valid Gumroad product id ()
-    - name, offer code's name and url slug
-    - amount_off, the amount off (in currency or percent, based on offer_type)
-    - offer_type, must be 'cent' or 'percent'
-    - max_purchase_count, max uses for this offer code
-    - universal, 'true' applies to all products, 'false only applies to the current product
+    Returns the list of coupon codes from the --csv file and the --coupon_codes option
     """
-    url = PRODUCT_URL + product_id + '/offer_codes/'
-    data = {
-        'access_token': access_token,
-        'product_id': product_id,
-        'name': name,
-        'amount_off': amount_off,
-        'offer_type': offer_type,
-        'max_purchase_count': max_purchase_count,
-        'universal': universal
-    }
-    return (url, data)
-
-
-def download_products_data():
-    """
-    Returns a dictionary of product name: { data_dict } and the total products count
-    """
-    r = requests.get('https://api.gumroad.com/v2/products', data={'access_token': access_token})
-    import json
-    data = r.json()
-
-    products = []
-    for p in data['products']:
-        p_dict = {
-            'name': p['name'],
-            'id': p['id'],
-            'short_url': p['short_url']
-        }
-        products.append(p_dict)
-    total = len(data['products'])
-    return products, total
-
-
-def recreate_coupon(product_code, coupon_code):
-    """
-    Deletes a coupon if it exists and re-creates it.
-    Use to re-create a coupon when a user didn't use it right or didn't
-    save the product in his Gumroad library
-    Returns None
-    """
-    delete_url = PRODUCT_URL + product_code + '/offer_codes/' + coupon_code
-    r = requests.delete(delete_url, data={'access_token': ACCESS_TOKEN}  )
-    url, data = create_coupon_request(product_code, coupon_code, '100')
-    r = requests.post(url, data)
+    coupon_codes = []
+    if args.csv:
+        if not os.path.exists(args.csv):
+            print('Could not find the csv file: the path does not exist. Operation aborted.')
+            sys.exit()
+        csv_data = get_csv_file_as_list(args.csv)
+        coupon_codes.extend([row[0].strip() for row in csv_data if row])
+    if args.coupon_codes:
+        coupon_codes.extend(args.coupon_codes)
+    return coupon_codes
 
 
 def get_csv_file_as_list(path, header=False):
@@ -182,55 +183,29 @@ def get_csv_file_as_list(path, header=False):
     return
 
 
-def batch_create_coupons(codes_list, product_id, amount_off=100, offer_type='percent'):
+def get_access_token(args):
     """
-    Take a list of coupon codes and sends post requests to create them on the Gumroad API,
-    for the given product_id
-    Returns two lists:
-    - created_codes, the coupons that were successfully created
-    - errors, a list of coupons that couldn't be created
+    Returns the access token passed with --access_token, or the one stored in the access_token file
+    Returns an empty string if there is none
     """
-    total_lines = len(codes_list)
-    current_progress = 0
-
-    created_codes, errors = [], []
-    for line in codes_list:
-        if line == '':
-            continue
-        url, data = create_coupon_request(product_id, line, str(amount_off), offer_type)
-        r = requests.post(url, data)
-        if r.ok:
-            created_codes.append(line)
-        else:
-            errors.append(line)
+    if args.access_token:
+        return args.access_token
+    if not os.path.exists(ACCESS_TOKEN_FILE):
+        return ''
+    with open(ACCESS_TOKEN_FILE, mode='r') as content:
+        return content.readline().strip()
 
-        current_progress += 1
-        print("\rProgress: {!s}/{!s}".format(current_progress, total_lines),
-            end="",
-            flush=True)
-    return codes_list
 
-
-
-args, mode, option = get_cli_arguments()
-
-access_token = None
-with open('access_token', mode='r') as content:
-    access_token = content.readline().strip()
-
-if not access_token:
-    if not args.access_token:
-        print('Missing Gumroad API access token. Put it in a file named access_token next to the script or use the --access_token option when you call the script from the shell.')
-        sys.exit()
-    access_token = args.access_token
-
-def get_product_info(ids, key='id'):
+def get_product_info(ids, key='id', products=None):
     """
     Searches the product in the list by id or by name
+    Uses the products from the products csv file if you don't pass a list of products
     Returns None if it can't find the product
     """
     if type(ids) is str:
         ids = [ids]
+    if products is None:
+        products = load_products()
 
     VALID_KEYS = ['id', 'name', 'url']
     if key not in VALID_KEYS:
@@ -245,39 +220,51 @@ def get_product_info(ids, key='id'):
     return product_ids if product_ids else None
 
 
-# SCRIPT
-# Create coupons
-product_ids = None
-if mode is Modes.POST:
+def ask_product_ids(args, products=None):
+    """
+    Returns the ids of the products passed with --product_ids
+    Lists the available products and asks for a valid name or id until it finds one
+    Uses the products from the products csv file if you don't pass a list of products
+    """
+    if not products:
+        products = load_products()
+    product_ids = None
     if args.product_ids:
-        product_ids = get_product_info(args.product_ids)
+        product_ids = get_product_info(args.product_ids, products=products)
         if product_ids is None:
             print("Couldn't find the product id or name.")
     else:
         print('No valid product id or name passed with the --product_ids option.')
+    if product_ids is None:
+        print_products(products)
     while product_ids is None:
         user_input = input('Please enter a valid product name or id (list above): ')
-        product_ids = get_product_info(user_input)
+        product_ids = get_product_info(user_input, products=products)
+    return product_ids
 
 
-if mode is Modes.POST and option is GumroadOptions.COUPONS:
-    coupon_codes = []
-    offer = {
+def get_offer(args):
+    return {
         'amount_off': args.cents_off if args.cents_off != 0 else args.percent_off,
         'type': 'cents' if args.cents_off != 0 else 'percent'
     }
 
-    if args.csv:
-        if not os.path.exists(args.csv):
-            print('Could not find the csv file: the path does not exist. Operation aborted.')
-            sys.exit()
-        csv_data = get_csv_file_as_list(args.csv)
-        coupon_codes.append(csv_data)
-    if args.coupon_codes:
-        coupon_codes.append(args.coupon_codes)
 
-    for p_id in product_ids:
-        batch_create_coupons(coupon_codes, p_id, offer['amount_off'], offer['type'])
+def create_coupons(client, args):
+    from journal import JobJournal
+
+    product_ids = ask_product_ids(args)
+    coupon_codes = get_coupon_codes(args)
+    offer = get_offer(args)
+
+    with JobJournal(args.journal) as journal:
+        if args.resume:
+            journal.load()
+        for p_id in product_ids:
+            created_codes, errors = client.batch_create_coupons(coupon_codes, p_id, offer['amount_off'], offer['type'], journal)
+            print('Product {!s}: created {!s} coupons, {!s} errors'.format(p_id, len(created_codes), len(errors)))
+            for code in errors:
+                print('- Could not create {!s}'.format(code))
 
     # Print coupon links
     # if len(coupon_codes) == 1:
@@ -285,34 +272,129 @@ if mode is Modes.POST and option is GumroadOptions.COUPONS:
     #         coupon_url = get_product_info(p_id, key='url') + '/' + coupon_codes[0]
     #         logging.log(coupon_url)
 
-if mode is Modes.GET and option is GumroadOptions.PRODUCTS:
-    products, total_count = download_products_data()
-    print('There are {!s} products in total'.format(total_count))
-
-    with open('products.csv', 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file, delimiter=',')
-        header = PRODUCT_KEYS
-        writer.writerow(header)
-
-        for product in products:
-            row = [product[key] for key in product.keys()]
-            writer.writerow(row)
-
-# delete coupons
-# Get coupon list
-# extract tuples of name: id so you can use the id to send a delete request
-# open the csv file and compare each entry to the names
-# delete if match found
-# url, data = create_coupon_request(PRODUCT_IDS.MAKE_PROFESSIONAL_2D_GAMES_WITH_GODOT, '', '100')
-# r = requests.get(url, data)
-# response_dict = json.loads(r.text)
-# count = 0
-
-# coupon_names = [coupon['name'].replace('\ufeff', '') for coupon in response_dict['offer_codes']]
-# with open(csv_file, mode='r', encoding='utf-8') as data:
-#     reader = csv.reader(data)
-#     for line in reader:
-#         coupon_name = str(line[2])
-#         url, data = create_coupon_request(PRODUCT_IDS.MAKE_PROFESSIONAL_2D_GAMES_WITH_GODOT, coupon_name, '100')
-#         r = requests.post(url, data)
-# sys.exit()
+
+def sync_coupons(client, args):
+    from cache import OfferCodesCache, sync_offer_codes, CACHE_FILE
+    from journal import JobJournal
+
+    cache = OfferCodesCache(CACHE_FILE, args.cache_max_age)
+    cache.load()
+    # Finds the products in the cached products list, downloaded again once it's too old
+    product_ids = ask_product_ids(args, cache.get_products(client, args.refresh))
+    coupon_codes = get_coupon_codes(args)
+    offer = get_offer(args)
+    with JobJournal(args.journal) as journal:
+        for p_id in product_ids:
+            report = sync_offer_codes(client, cache, p_id, coupon_codes, offer['amount_off'], offer['type'], args.prune, journal, args.refresh)
+            cache.save()
+            if report is None:
+                continue
+            print('Product {!s}: {!s} to create, {!s} to delete, {!s} unchanged'.format(
+                p_id, len(report['to_create']), len(report['to_delete']), len(report['unchanged'])))
+            if report['to_delete'] and not args.prune:
+                print('Use --prune to delete the {!s} coupons that are not in the list'.format(len(report['to_delete'])))
+            for code in report['create_errors']:
+                print('- Could not create {!s}'.format(code))
+            for code in report['delete_errors']:
+                print('- Could not delete {!s}'.format(code))
+
+
+def delete_coupons(client, args):
+    from cache import normalize_coupon_name
+
+    # Offer code names are normalized too, e.g. without the byte order mark of csv files saved with Excel
+    coupon_codes = [normalize_coupon_name(code) for code in get_coupon_codes(args)]
+    coupon_codes = [code for code in coupon_codes if code]
+    if not coupon_codes and not args.pattern:
+        print('Pass the coupons to delete with --csv, --coupon_codes or --pattern. Operation aborted.')
+        sys.exit()
+    product_ids = ask_product_ids(args)
+
+    failed_product_ids, error_count = [], 0
+    for p_id in product_ids:
+        offer_code_ids = client.find_offer_code_ids(p_id, coupon_codes, args.pattern)
+        if offer_code_ids is None:
+            print('Product {!s}: could not download the coupons, skipping the product'.format(p_id))
+            failed_product_ids.append(p_id)
+            continue
+        if not offer_code_ids:
+            print('Product {!s}: no matching coupons to delete'.format(p_id))
+            continue
+        missing_codes = set(coupon_codes) - set(offer_code_ids)
+        if missing_codes:
+            print('Product {!s}: {!s} coupons from the list do not exist'.format(p_id, len(missing_codes)))
+        if not args.yes:
+            answer = input('Delete {!s} coupons from product {!s}? [y/N] '.format(len(offer_code_ids), p_id))
+            if answer.lower() not in ['y', 'yes']:
+                continue
+
+        deleted_codes, errors = client.batch_delete_coupons(offer_code_ids, p_id)
+        error_count += len(errors)
+        print('Product {!s}: deleted {!s} coupons, {!s} errors'.format(p_id, len(deleted_codes), len(errors)))
+        for code in errors:
+            print('- Could not delete {!s}'.format(code))
+
+    if failed_product_ids or error_count:
+        print('Failed: {!s} coupons could not be deleted, and the coupons of {!s} products could not be downloaded: {!s}'.format(
+            error_count, len(failed_product_ids), ', '.join(failed_product_ids)))
+        sys.exit(1)
+
+
+def download_products(client, args):
+    from client import GumroadError
+    from export import download_products_csv
+
+    try:
+        total_count = download_products_csv(client, args.output or PRODUCTS_FILE, PRODUCT_KEYS)
+        print('There are {!s} products in total'.format(total_count))
+    except GumroadError as error:
+        print('{!s}. The products csv file was not changed.'.format(error))
+
+
+def download_coupons(client, args):
+    from client import GumroadError
+    from export import download_offer_codes_csv
+
+    if args.product_ids:
+        product_ids = get_product_info(args.product_ids)
+    else:
+        product_ids = [product[ProductKeys.ID.value] for product in load_products()]
+    if not product_ids:
+        print("Couldn't find the product id or name.")
+        sys.exit()
+    try:
+        total_count = download_offer_codes_csv(client, product_ids, args.output or COUPONS_FILE)
+        print('Downloaded {!s} coupons from {!s} products'.format(total_count, len(product_ids)))
+    except GumroadError as error:
+        print('{!s}. The coupons csv file was not changed.'.format(error))
+
+
+COMMANDS = {
+    (Modes.GET, GumroadOptions.PRODUCTS): download_products,
+    (Modes.GET, GumroadOptions.COUPONS): download_coupons,
+    (Modes.POST, GumroadOptions.COUPONS): create_coupons,
+    (Modes.SYNC, GumroadOptions.COUPONS): sync_coupons,
+    (Modes.DELETE, GumroadOptions.COUPONS): delete_coupons,
+}
+
+
+def main(argv=None):
+    args, mode, option = get_cli_arguments(argv)
+    command = COMMANDS.get((mode, option))
+    if not command:
+        print('The {!s} mode does not support {!s} yet.'.format(mode.value, option.value))
+        sys.exit()
+
+    access_token = get_access_token(args)
+    if not access_token:
+        print('Missing Gumroad API access token. Put it in a file named access_token next to the script or use the --access_token option when you call the script from the shell.')
+        sys.exit()
+
+    from client import GumroadClient
+    from rate_limiter import RateLimiter
+    client = GumroadClient(access_token, args.concurrency, rate_limiter=RateLimiter(args.rate))
+    command(client, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Append-only journal of bulk coupon jobs, so an interrupted job can resume where it stopped.
+
+Each line of the csv file is product_id,coupon name,status. The status is 'created' or 'error'.
+The file is only ever appended to, so a crash can at most lose the line being written.
+"""
+import os
+import csv
+from enum import Enum
+
+
+class JobStatus(Enum):
+    CREATED = 'created'
+    ERROR = 'error'
+
+
+class JobJournal:
+    """
+    Records the result of every coupon request as it comes in
+    Use `completed` to find the (product_id, name) pairs that were already created
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self._file = None
+        self._writer = None
+
+    def load(self):
+        """
+        Reads the entries of a previous job from the journal file, if it exists
+        A coupon stays completed once created, even if a later run failed to create it again
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode='r', encoding='utf-8', newline='') as journal_file:
+            for row in csv.reader(journal_file):
+                if len(row) < 3:
+                    continue
+                product_id, name, status = row[:3]
+                if status == JobStatus.CREATED.value:
+                    self.completed.add((product_id, name))
+
+    def is_completed(self, product_id, name):
+        return (product_id, name) in self.completed
+
+    def record(self, product_id, name, status):
+        """
+        Appends an entry to the journal file and flushes it right away
+        status is a member of the JobStatus Enum
+        """
+        if not self._file:
+            self._file = open(self.path, mode='a', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+        self._writer.writerow([product_id, name, status.value])
+        self._file.flush()
+        if status is JobStatus.CREATED:
+            self.completed.add((product_id, name))
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,110 @@
+"""
+Client-side rate limiting and retries for the Gumroad API.
+"""
+import random
+import threading
+import time
+
+from defaults import DEFAULT_RATE
+
+
+DEFAULT_MAX_RATE = 100.0
+DEFAULT_MIN_RATE = 0.5
+DEFAULT_MAX_RETRIES = 5
+
+# Methods we can safely send again if the server failed while processing them
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds to wait from a Retry-After header value,
+    either a number of seconds or an http date. Returns None if the value is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def get_backoff_delay(attempt, base_delay=0.5, max_delay=30.0):
+    """
+    Returns a random delay between 0 and base_delay * 2^attempt seconds, capped to max_delay
+    The randomness spreads out the retries of concurrent requests
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket that starts at `rate` requests per second
+    and adapts to the server's responses:
+    - every successful response raises the rate by `increase`, up to max_rate
+    - a 429 response halves the rate and pauses all requests for the Retry-After delay
+    - a 5xx response lowers the rate by 20%
+    Concurrent requests often fail together: the rate only goes down once per cooldown period
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE, min_rate=DEFAULT_MIN_RATE, increase=0.1, burst=None, cooldown=1.0):
+        self.rate = rate
+        self.max_rate = max(max_rate, rate)
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase
+        self.burst = burst if burst else max(rate, 1.0)
+        self.tokens = self.burst
+        self.paused_until = 0.0
+        self.cooldown = cooldown
+        self._next_decrease = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """
+        Blocks until the bucket has a token for one request
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def on_response(self, status_code, retry_after=None):
+        """
+        Adapts the rate to a response's status code and Retry-After delay in seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            if status_code == 429:
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                self.tokens = 0
+                self._decrease(now, 0.5)
+            elif status_code >= 500:
+                self._decrease(now, 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def _decrease(self, now, factor):
+        if now < self._next_decrease:
+            return
+        self.rate = max(self.min_rate, self.rate * factor)
+        self._next_decrease = now + self.cooldown
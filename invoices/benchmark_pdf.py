@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the pdf rendering throughput of one wkhtmltopdf process per invoice
+with batches of invoices per process.
+
+Copies an html invoice `count` times to a temporary folder and renders the copies with both modes.
+
+`python benchmark_pdf.py dist/2017/html/2017-01-05-0001-google.html --count 200 --batch-size 20`
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import time
+
+from pdf import render_pdfs
+
+
+def get_cli_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark pdf rendering modes for invoices')
+    parser.add_argument('html_path', type=str, help='Rendered html invoice to use as the sample. Its css and img files must be next to it')
+    parser.add_argument('-n', '--count', type=int, default=100, help='Number of invoices to render with each mode. Default: 100')
+    parser.add_argument('-b', '--batch-size', type=int, default=20, help='Invoices per wkhtmltopdf process in batch mode. Default: 20')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of wkhtmltopdf processes at the same time. Default: the number of CPUs')
+    return parser.parse_args()
+
+
+def prepare_sample_folder(html_path, count):
+    """
+    Returns a temporary folder with an html subfolder that holds count copies of the sample invoice
+    and the paths to the copies
+    """
+    temp_folder = tempfile.mkdtemp(prefix='invoices-benchmark-')
+    html_folder = os.path.join(temp_folder, 'html')
+    os.makedirs(html_folder)
+
+    source_folder = os.path.dirname(os.path.abspath(html_path))
+    for name in ['style.css', 'img']:
+        path = os.path.join(source_folder, name)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(html_folder, name))
+        elif os.path.isfile(path):
+            shutil.copy(path, html_folder)
+
+    html_paths = []
+    for index in range(count):
+        path = os.path.join(html_folder, 'invoice-{:05d}.html'.format(index))
+        shutil.copy(html_path, path)
+        html_paths.append(path)
+    return temp_folder, html_paths
+
+
+def benchmark(html_paths, jobs, batch_size):
+    start = time.perf_counter()
+    rendered_count, failed = render_pdfs(html_paths, jobs=jobs, batch_size=batch_size)
+    duration = time.perf_counter() - start
+    return duration, rendered_count, len(failed)
+
+
+if __name__ == '__main__':
+    args = get_cli_arguments()
+    if not os.path.isfile(args.html_path):
+        print('Could not find the html file {!s}'.format(args.html_path))
+        sys.exit(1)
+
+    temp_folder, html_paths = prepare_sample_folder(args.html_path, args.count)
+    try:
+        modes = [('one process per invoice', 1), ('{!s} invoices per process'.format(args.batch_size), args.batch_size)]
+        for label, batch_size in modes:
+            duration, rendered, failed = benchmark(html_paths, args.jobs, batch_size)
+            print('{!s}: {!s} rendered, {!s} failed in {:.2f}s, {:.1f} invoices/s'.format(
+                label, rendered, failed, duration, rendered / duration if duration else 0))
+    finally:
+        shutil.rmtree(temp_folder)
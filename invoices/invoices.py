@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import json
-import subprocess
 import os
 import shutil
 import csv
@@ -11,6 +10,9 @@ import datetime
 import sys
 import codecs
 
+from pdf import render_pdfs, print_pdf_report
+from refactor.products import Product, ProductsDatabase
+
 
 DATABASE_PATH = '2017.csv'
 HTML_TEMPLATE_PATH = 'invoice.html'
@@ -19,6 +21,9 @@ OUTPUT_FOLDER = 'dist'
 locale.setlocale(locale.LC_TIME, 'fr')
 DATE_FORMAT = '%d %B %Y'
 
+RE_TEMPLATE_PLACEHOLDER = re.compile(r'{{ *(\w+) *}}')
+PRICE_IDENTIFIERS = ['product_unit_price', 'product_total_tax_excl', 'total_discount', 'total_excl_tax', 'total_tax', 'total_incl_tax']
+
 DEBUG = False
 
 options = {
@@ -32,6 +37,12 @@ options = {
     },
     'debug': {
         'csv_max_parsed_rows': 5
+    },
+    'pdf': {
+        'jobs': os.cpu_count(),
+        'timeout': 60,
+        'wkhtmltopdf_args': ['--quiet'],
+        'batch_size': 20
     }
 }
 
@@ -160,33 +171,6 @@ class InvoiceTemplate:
                     line_id += 1
 
 
-class ProductsDatabase:
-    """
-    Stores a list of products.
-    Retrieves them by ID or by name.
-    """
-
-    def __init__(self):
-        self.products = []
-        self.product_names = []
-
-
-    def find_product(indentifier):
-        product = None
-        if identifier.isdigit():
-            index = int(identifier)
-            product = self.products[index]
-        else:
-            for index, name in enumerate(product_names):
-                if identifier == name:
-                    product = products[index]
-        if not product:
-            logging.warning('Could not find product id {!s}, returning None'.format(identifier))
-        return product
-
-
-
-
 def parse_invoice_date(date_string):
     date, payment_date = None, None
 
@@ -198,49 +182,59 @@ def parse_invoice_date(date_string):
 
 
 
-def parse_html_template(html_doc):
-    invoice_template, re_matches = [], []
-
-    line_id = 0
-    for line in html_doc:
-        match = re.match(r'.+{{ (.*) }}', line)
-        if match:
-            identifier = match.group(1)
-
-            # Pre-replace company details
-            if identifier.startswith('company'):
-                category, key = identifier.split('_', maxsplit=1)
-                string_template = '{{ ' + identifier + ' }}'
-                line = line.replace(string_template, company[key], 1)
-            else:
-                re_matches.append((line_id, match.group(1)))
-        invoice_template.append(line)
-        line_id += 1
-
-    return invoice_template, re_matches
-
-
-
-def get_product_from_id(product_id):
-    product = {}
+def compile_html_template(html_doc, company):
+    """
+    Splits the html template into literal text and {{ identifier }} placeholders, in one pass,
+    with any number of placeholders per line
+    Replaces the company_* placeholders with their value right away
+    Returns a tuple of literals, placeholders: literals has one more element than placeholders,
+    and each placeholder is a tuple of identifier, category, key, is_price
+    """
+    literals, placeholders = [], []
+    literal = []
+    position = 0
+    for match in RE_TEMPLATE_PLACEHOLDER.finditer(html_doc):
+        literal.append(html_doc[position:match.start()])
+        position = match.end()
+
+        identifier = match.group(1)
+        category, key = identifier.split('_', maxsplit=1) if '_' in identifier else (identifier, '')
+        if category == 'company':
+            try:
+                literal.append(str(company[key]))
+            except KeyError:
+                logging.warning('Could not find matching value for {!s}'.format(identifier))
+                literal.append(identifier)
+            continue
 
-    if product_id.isdigit():
-        index = int(product_id)
-        product = product_database[index]
-    else:
-        for index, name in enumerate(product_names):
-            if product_id == name:
-                product = product_database[index]
+        literals.append(''.join(literal))
+        literal = []
+        placeholders.append((identifier, category, key, identifier in PRICE_IDENTIFIERS))
+    literal.append(html_doc[position:])
+    literals.append(''.join(literal))
+    return literals, placeholders
 
-    if not product:
-        logging.warning('Could not find product id {!s}, returning None'.format(product_id))
-    return product
 
+def render_html_template(template, data):
+    """
+    Returns the compiled template as a string with the placeholders replaced by values from data
+    """
+    literals, placeholders = template
+    currency = data['invoice']['currency']
+    parts = [literals[0]]
+    for (identifier, category, key, is_price), literal in zip(placeholders, literals[1:]):
+        try:
+            value = data[category][key]
+        except KeyError:
+            value = identifier
+            logging.warning('Could not find matching value for {!s}'.format(identifier))
+        parts.append(str(value) + currency if is_price else str(value))
+        parts.append(literal)
+    return ''.join(parts)
 
 
-def convert_invoice_to_html(invoice_data, company):
-    invoice_template_copy = list(invoice_template)
 
+def convert_invoice_to_html(invoice_data):
     # PRODUCT
     # TODO: to support multiple products, parse products in a separate function
     # Use a separate html template (one <tr> per product)
@@ -249,25 +243,24 @@ def convert_invoice_to_html(invoice_data, company):
 
     product_data = invoice_data['product']
     amount = invoice_data['product']['quantity']
-    product = get_product_from_id(product_data['identifier'])
+    product = products_database.find_product(product_data['identifier'])
     if not product:
-        product = {
-            'name': invoice_data['product']['identifier'],
-            'VAT_rate': 0,
-            'unit_price': float(invoice_data['product']['price'].replace(',', '.'))
-        }
+        product = Product(None,
+                          invoice_data['product']['identifier'],
+                          float(invoice_data['product']['price'].replace(',', '.')),
+                          0)
 
 
-    VAT_rate = 0 if options['no_VAT'] == True else product['VAT_rate']
-    product_cost_tax_excl = product['unit_price'] * amount
+    VAT_rate = 0 if options['no_VAT'] == True else product.VAT_rate
+    product_cost_tax_excl = product.unit_price * amount
     product_VAT = product_cost_tax_excl * VAT_rate
 
     total_tax_excl += product_cost_tax_excl
     total_VAT += product_VAT
 
     # TODO: refactor invoice into object
-    invoice_data['product']['name'] = product['name']
-    invoice_data['product']['unit_price'] = product['unit_price']
+    invoice_data['product']['name'] = product.name
+    invoice_data['product']['unit_price'] = product.unit_price
     invoice_data['product']['VAT_rate'] = VAT_rate
     invoice_data['product']['total_tax_excl'] = product_cost_tax_excl
 
@@ -277,19 +270,7 @@ def convert_invoice_to_html(invoice_data, company):
     invoice_data['total']['tax'] = total_VAT
     invoice_data['total']['incl_tax'] = total_tax_excl + total_VAT
 
-    # REPLACE VALUES
-    for index, identifier in re_matches:
-        string_template = '{{ ' + identifier + ' }}'
-        category, key = identifier.split('_', maxsplit=1)
-        try:
-            replace_value = invoice_data[category][key]
-        except:
-            replace_value = identifier
-            logging.warning('Could not find matching value for {!s}'.format(identifier))
-        if identifier in ['product_unit_price', 'product_total_tax_excl', 'total_discount', 'total_excl_tax', 'total_tax', 'total_incl_tax']:
-            replace_value = str(replace_value) + invoice_data['invoice']['currency']
-        invoice_template_copy[index] = invoice_template_copy[index].replace(string_template, str(replace_value), 1)
-    return invoice_template_copy
+    return render_html_template(invoice_template, invoice_data)
 
 
 
@@ -328,32 +309,24 @@ with codecs.open('bank-details.html', 'r', encoding='utf-8') as html_doc:
 
 
 # Parse product database
-product_database = []
-product_names = []
-with open('products.csv', 'r') as csv_file:
-    reader = csv.reader(csv_file)
-    header = next(reader)
-
-    product = {}
-    for row in reader:
-        product_names.append(row[0])
-        product['name'] = row[0]
-        product['unit_price'] = float(row[1])
-        product['VAT_rate'] = float(row[2]) / 100
-        product_database.append(product)
+products_database = ProductsDatabase()
+products_database.load_csv('products.csv')
 
 
 with codecs.open(HTML_TEMPLATE_PATH, 'r', encoding='utf-8') as html_doc:
-    invoice_template, re_matches = parse_html_template(html_doc)
-    if not invoice_template:
+    invoice_template = compile_html_template(html_doc.read(), company)
+    literals, placeholders = invoice_template
+    if not any(literals):
         logging.error('Could not load the invoice template. Aborting operation.')
-    if not re_matches:
+    if not placeholders:
         logging.error('Missing {{ indentifier }} templates to replace in the html template. Aborting operation.')
 
 
 # prepare invoice data
 def prepare_invoice_data():
-    db = []
+    """
+    Reads the csv database one row at a time and yields the invoice data for each row
+    """
     with codecs.open(DATABASE_PATH, 'r', encoding='utf-8') as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=',')
         header = next(csv_reader)
@@ -385,18 +358,32 @@ def prepare_invoice_data():
                     'details': get_payment_details(row[8])
                 }
             }
-            db.append(invoice_data)
+            yield invoice_data
             if DEBUG and invoice_index >= options['debug']['csv_max_parsed_rows']:
                 break
-    return db
 
 
-# SCRIPT
-invoices_database = prepare_invoice_data()
+def write_invoices_html(invoices, html_export_path):
+    """
+    Renders and writes each invoice to an html file as it comes in
+    Yields the path of every written file
+    """
+    for invoice in invoices:
+        invoice_as_html = convert_invoice_to_html(invoice)
+
+        export_date = datetime.datetime.strptime(invoice['invoice']['date'], DATE_FORMAT)
+        export_date_string = export_date.strftime('%Y-%m-%d')
+        client_name = invoice['client']['name'].replace(' ', '-').lower()
+
+        file_name = '{}-{}.html'.format(invoice['invoice']['index'], client_name)
+        export_path = '{}/{}-{}'.format(html_export_path, export_date_string, file_name)
+
+        with codecs.open(export_path, 'w', encoding='utf-8') as invoice_file:
+            invoice_file.write(invoice_as_html)
+        yield export_path
 
-# HTML FILES
-html_export_paths = []
 
+# SCRIPT
 db_file_name, _ = os.path.splitext(DATABASE_PATH)
 html_export_path = '{}/{}/html'.format(OUTPUT_FOLDER, db_file_name)
 
@@ -411,22 +398,13 @@ img_output_path = os.path.join(html_export_path, 'img')
 if not os.path.exists(img_output_path):
     shutil.copytree('img', img_output_path)
 
-# Generate html files
-for invoice in invoices_database:
-    invoice_as_html = convert_invoice_to_html(invoice, company)
-
-    export_date = datetime.datetime.strptime(invoice['invoice']['date'], DATE_FORMAT)
-    export_date_string = export_date.strftime('%Y-%m-%d')
-    client_name = invoice['client']['name'].replace(' ', '-').lower()
-
-    file_name = '{}-{}.html'.format(invoice['invoice']['index'], client_name)
-    export_path = '{}/{}-{}'.format(html_export_path, export_date_string, file_name)
-
-    html_export_paths.append(export_path)
-
-    with codecs.open(export_path, 'w', encoding='utf-8') as invoice_file:
-        invoice_file.writelines(invoice_as_html)
+# Stream csv rows -> invoice data -> html files -> pdf files
+# Each stage pulls from the previous one, so the first pdfs render before the whole csv is read
+invoices = prepare_invoice_data()
+html_export_paths = write_invoices_html(invoices, html_export_path)
 
 # Build PDFs
-for path in html_export_paths:
-    subprocess.run('wkhtmltopdf {} {}.pdf'.format(path, os.path.splitext(path)[0].replace('html/', '')))
+rendered_count, failed = render_pdfs(html_export_paths, **options['pdf'])
+print_pdf_report(rendered_count, failed)
+if failed:
+    sys.exit(1)
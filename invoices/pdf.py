@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Converts html invoices to pdf with wkhtmltopdf
+
+Starting wkhtmltopdf and its Qt engine costs more than rendering a small invoice.
+With batch_size > 1, each wkhtmltopdf process converts batch_size invoices, reading one
+conversion per line from stdin with the --read-args-from-stdin option. Every invoice still
+gets its own pdf file.
+"""
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+
+WKHTMLTOPDF = 'wkhtmltopdf'
+# Every complete pdf file ends with this marker, optionally followed by a line break
+PDF_END_MARKER = b'%%EOF'
+
+
+def get_pdf_path(html_path):
+    """
+    Returns the path of the pdf file to render from html_path, one folder up from the html folder
+    """
+    html_folder, file_name = os.path.split(html_path)
+    return os.path.join(os.path.dirname(html_folder), os.path.splitext(file_name)[0] + '.pdf')
+
+
+def quote_stdin_arg(arg):
+    """
+    Quotes an argument for wkhtmltopdf's --read-args-from-stdin parser
+    """
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def run_wkhtmltopdf(command, timeout, stdin_text=None):
+    """
+    Runs wkhtmltopdf and returns a tuple of exit code, error message
+    """
+    try:
+        process = subprocess.run(command,
+                                 input=stdin_text.encode('utf-8') if stdin_text else None,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 timeout=timeout)
+        return process.returncode, process.stderr.decode('utf-8', errors='replace').strip()
+    except subprocess.TimeoutExpired:
+        return -1, 'Timed out after {!s} seconds'.format(timeout)
+    except OSError as error:
+        return -1, str(error)
+
+
+def is_complete_pdf(pdf_path):
+    """
+    Returns True if the pdf file exists and ends with the %%EOF marker,
+    so a file wkhtmltopdf was still writing when it got stopped doesn't count
+    """
+    try:
+        with open(pdf_path, 'rb') as pdf_file:
+            pdf_file.seek(0, os.SEEK_END)
+            pdf_file.seek(max(pdf_file.tell() - 1024, 0))
+            return PDF_END_MARKER in pdf_file.read()
+    except OSError:
+        return False
+
+
+def get_result(html_path, pdf_path, returncode, error):
+    """
+    Returns a dict with the html path, pdf path, exit code and error message
+    The pdf counts as rendered if it is complete, whatever the exit code: wkhtmltopdf exits with 1
+    on warnings, e.g. a missing image, but still writes the pdf
+    """
+    if is_complete_pdf(pdf_path):
+        return {'html': html_path, 'pdf': pdf_path, 'returncode': 0, 'error': ''}
+    return {
+        'html': html_path,
+        'pdf': pdf_path,
+        'returncode': returncode if returncode != 0 else -1,
+        'error': error if error else 'wkhtmltopdf did not write the complete pdf file',
+    }
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def render_pdf(html_path, pdf_path, timeout=None, wkhtmltopdf_args=None):
+    """
+    Converts an html file to pdf with wkhtmltopdf
+    Returns a dict with the html path, pdf path, exit code and error message
+    """
+    remove_file(pdf_path)
+    command = [WKHTMLTOPDF] + (wkhtmltopdf_args or []) + [html_path, pdf_path]
+    returncode, error = run_wkhtmltopdf(command, timeout)
+    return get_result(html_path, pdf_path, returncode, error)
+
+
+def render_pdf_batch(html_paths, timeout=None, wkhtmltopdf_args=None):
+    """
+    Converts several html files to pdf with a single wkhtmltopdf process
+    The timeout applies to each invoice, so the batch gets timeout * len(html_paths) seconds
+    If the batch stops before the end, e.g. on a timeout or a crash, renders the invoices
+    it didn't complete one at a time, so one hung invoice doesn't fail the others
+    Returns a list of dicts with the html path, pdf path, exit code and error message
+    """
+    if len(html_paths) == 1:
+        return [render_pdf(html_paths[0], get_pdf_path(html_paths[0]), timeout, wkhtmltopdf_args)]
+
+    pdf_paths = [get_pdf_path(path) for path in html_paths]
+    for pdf_path in pdf_paths:
+        remove_file(pdf_path)
+
+    lines = [quote_stdin_arg(html) + ' ' + quote_stdin_arg(pdf) for html, pdf in zip(html_paths, pdf_paths)]
+    command = [WKHTMLTOPDF] + (wkhtmltopdf_args or []) + ['--read-args-from-stdin']
+    batch_timeout = timeout * len(html_paths) if timeout else None
+    returncode, error = run_wkhtmltopdf(command, batch_timeout, '\n'.join(lines) + '\n')
+
+    results = []
+    for html_path, pdf_path in zip(html_paths, pdf_paths):
+        result = get_result(html_path, pdf_path, returncode, error)
+        if result['returncode'] != 0:
+            result = render_pdf(html_path, pdf_path, timeout, wkhtmltopdf_args)
+        results.append(result)
+    return results
+
+
+def iter_batches(iterable, batch_size):
+    """
+    Yields lists of up to batch_size items from iterable, without reading it all first
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def render_pdfs(html_paths, jobs=None, timeout=None, wkhtmltopdf_args=None, batch_size=1):
+    """
+    Renders html files to pdf running up to `jobs` wkhtmltopdf processes at the same time
+    Each process renders batch_size invoices
+    html_paths can be a generator: conversions start as soon as a batch is ready, and
+    the function only pulls new paths when a worker is free, so memory use stays flat
+    Returns the number of rendered invoices and the list of failed results
+    """
+    jobs = jobs or os.cpu_count() or 1
+    batch_size = max(batch_size, 1)
+    rendered_count, failed = 0, []
+    pending = set()
+
+    def collect(futures):
+        nonlocal rendered_count
+        for future in futures:
+            for result in future.result():
+                if result['returncode'] == 0:
+                    rendered_count += 1
+                else:
+                    failed.append(result)
+        print('\rPDF: {!s} rendered, {!s} failed'.format(rendered_count, len(failed)), end='', flush=True)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for batch in iter_batches(html_paths, batch_size):
+            if len(pending) >= jobs:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(render_pdf_batch, batch, timeout, wkhtmltopdf_args))
+        collect(as_completed(pending))
+    print()
+    return rendered_count, failed
+
+
+def print_pdf_report(rendered_count, failed):
+    print('Rendered {!s} pdf invoices, {!s} failed'.format(rendered_count, len(failed)))
+    for result in failed:
+        print('- {!s}: {!s}'.format(result['html'], result['error']))
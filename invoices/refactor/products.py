@@ -1,25 +1,67 @@
+import csv
 import logging
+from collections import namedtuple
+
+
+Product = namedtuple('Product', ['id', 'name', 'unit_price', 'VAT_rate'])
+
 
 class ProductsDatabase:
     """
     Stores a list of products.
-    Retrieves them by ID or by name.
+    Retrieves them by ID or by name, exact, case-insensitive or partial, in constant time.
+    The product's ID is its row index in the csv file.
     """
 
     def __init__(self):
         self.products = []
-        self.product_names = []
+        self.products_by_name = {}
+        self._products_by_folded_name = {}
+        self._products_by_prefix = {}
+
+    def load_csv(self, path):
+        """
+        Loads products from a csv file with a header row and
+        one name, unit price, VAT rate in percent per row
+        """
+        with open(path, 'r', encoding='utf-8') as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader)
+            for row in reader:
+                self.add_product(row[0], float(row[1]), float(row[2]) / 100)
+
+    def add_product(self, name, unit_price, VAT_rate):
+        product = Product(len(self.products), name, unit_price, VAT_rate)
+        self.products.append(product)
+        self.products_by_name.setdefault(name, product)
+
+        folded_name = name.casefold()
+        self._products_by_folded_name.setdefault(folded_name, product)
+        # Several products can share a prefix: store None so the lookup doesn't pick one at random
+        for length in range(1, len(folded_name) + 1):
+            prefix = folded_name[:length]
+            if prefix in self._products_by_prefix and self._products_by_prefix[prefix] is not product:
+                self._products_by_prefix[prefix] = None
+            else:
+                self._products_by_prefix[prefix] = product
+        return product
 
     def find_product(self, identifier):
+        """
+        Returns the product with the ID or name, trying in order: ID, exact name,
+        case-insensitive name, then the start of a name if only one product matches it
+        Returns None if it can't find the product
+        """
         product = None
         if identifier.isdigit():
             index = int(identifier)
-            product = self.products[index]
-        else:
-            for index, name in enumerate(self.product_names):
-                if identifier != name:
-                    return
+            if index < len(self.products):
                 product = self.products[index]
+        else:
+            folded_identifier = identifier.casefold()
+            product = (self.products_by_name.get(identifier)
+                       or self._products_by_folded_name.get(folded_identifier)
+                       or self._products_by_prefix.get(folded_identifier))
         if not product:
             logging.warning('Could not find product id {!s}, returning None'.format(identifier))
         return product
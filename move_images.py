@@ -1,55 +1,398 @@
 """
 Find and move images in *.md files from ./ to ./img. Renames the image paths in the markdown files too.
 Either works on .md files you pass as arguments or finds them in the directory and subdirectories
+
+Only rewrites the links to local images that exist, and only writes the markdown files that changed.
+
+With --dedupe, hashes every linked image and keeps one file per content: it moves each unique image
+to an img folder once, points all the links to that copy, and deletes the duplicates.
+It also lists the orphaned images that no markdown file links to.
+
+The script works in two steps. It first plans every markdown edit, image move and deletion in memory,
+without writing anything. Use --dry_run to print the plan as JSON and stop there.
+It then applies the plan as one transaction: if any step fails, it undoes the steps it already did.
 """
 
 import os
-import glob
-import fileinput
 import re
 import sys
+import json
+import shutil
+import argparse
+import tempfile
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+IMG_FOLDER = 'img'
+# Matches ![alt](path) and ![alt](path "title"), anywhere in a line
+RE_IMAGE = re.compile(r'!\[(?P<alt>[^\]]*)\]\((?P<path>[^)\s]+)(?P<title>\s+"[^"]*")?\)')
+RE_URL = re.compile(r'^[a-z][a-z0-9+.-]*:', re.IGNORECASE)
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.bmp']
+HASH_CHUNK_SIZE = 1024 * 1024
+# Images to delete get renamed with this suffix until the whole plan is applied
+TRASH_SUFFIX = '.move_images-deleted'
+
+
+class PlanError(Exception):
+    """Raised when we can't plan the changes, or the files on disk changed since the plan was made"""
+
+
+class Plan:
+    """
+    Every change to make on disk, computed without writing anything:
+    - edits, a dict of markdown file path: (original text, new text, list of (old link, new link))
+    - moves, a dict of image source path: destination path
+    - deletes, the list of duplicate images to delete
+    - orphans, the list of images no markdown file links to once the plan is applied
+    """
+
+    def __init__(self):
+        self.edits = {}
+        self.moves = {}
+        self.deletes = []
+        self.orphans = []
+
+    def is_empty(self):
+        return not (self.edits or self.moves or self.deletes)
+
+    def to_json(self):
+        data = {
+            'edits': [{'path': path, 'links': [{'from': old, 'to': new} for old, new in links]}
+                      for path, (_, _, links) in sorted(self.edits.items())],
+            'moves': [{'source': source, 'destination': destination} for source, destination in sorted(self.moves.items())],
+            'deletes': sorted(self.deletes),
+            'orphans': sorted(self.orphans),
+        }
+        return json.dumps(data, indent=2)
+
+
+def get_cli_arguments():
+    parser = argparse.ArgumentParser(description='Move the images that markdown files link to into img folders, and update the links')
+    parser.add_argument('paths', nargs='*', default=['.'], help='Markdown files, or folders to search for markdown files recursively. Default: the current directory')
+    parser.add_argument('-d', '--dedupe', action='store_true', help='Keep a single copy of identical images, link every lesson to it, and list the images nothing links to')
+    parser.add_argument('-n', '--dry_run', action='store_true', help='Print the planned edits, moves and deletions as JSON without changing any file')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of files to read at the same time. Default: the number of CPUs')
+    return parser.parse_args()
+
+
+def find_files(paths, extensions):
+    """
+    Returns the absolute path of the files in paths with one of the extensions, walking folders recursively
+    Skips hidden folders like .git. Walks folders in alphabetical order, so the result doesn't depend on the filesystem
+    """
+    found = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                found.extend(os.path.join(root, f) for f in sorted(files) if os.path.splitext(f)[1].lower() in extensions)
+        elif os.path.splitext(path)[1].lower() in extensions and os.path.isfile(path):
+            found.append(path)
+    return found
+
+
+def find_markdown_files(paths):
+    return find_files(paths, ['.md'])
+
+
+def resolve_image_path(folder, image_path):
+    """
+    Returns the absolute path of the local image the link points to,
+    or None if the link is a url or the file doesn't exist
+    """
+    if RE_URL.match(image_path) or os.path.isabs(image_path):
+        return None
+    source = os.path.normpath(os.path.join(folder, image_path))
+    return source if os.path.isfile(source) else None
+
+
+def is_in_img_folder(path):
+    return os.path.basename(os.path.dirname(path)) == IMG_FOLDER
+
+
+def get_image_source(folder, image_path):
+    """
+    Returns the absolute path of the image the link points to,
+    or None if the link is a url, the image is already in an img folder, or the file doesn't exist
+    """
+    if image_path.replace('\\', '/').split('/')[0] == IMG_FOLDER:
+        return None
+    source = resolve_image_path(folder, image_path)
+    return None if source and is_in_img_folder(source) else source
+
+
+def get_file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def format_image_link(match, path):
+    return '![{!s}]({!s}{!s})'.format(match.group('alt'), path, match.group('title') or '')
+
+
+def read_text(file_path):
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def read_texts(file_paths, jobs=None):
+    """Reads the files on up to `jobs` threads and returns a dict of path: text"""
+    with ThreadPoolExecutor(max_workers=max(jobs or os.cpu_count() or 1, 1)) as executor:
+        return dict(zip(file_paths, executor.map(read_text, file_paths)))
+
+
+def add_edit(plan, file_path, text, get_new_path):
+    """
+    Calls get_new_path(match) for every image link in the text. It returns the new image path or None to keep the link
+    Adds the file to the plan's edits if any link changed
+    """
+    links = []
+
+    def replace(match):
+        new_path = get_new_path(match)
+        if not new_path:
+            return match.group(0)
+        links.append((match.group('path'), new_path))
+        return format_image_link(match, new_path)
+
+    new_text = RE_IMAGE.sub(replace, text)
+    if new_text != text:
+        plan.edits[file_path] = (text, new_text, links)
+
+
+def plan_relink(markdown_files, jobs=None):
+    """
+    Plans to move the images the markdown files link to into an img folder next to the image,
+    so images stay in their chapter, and to update the links
+    Moves each image once and points every link to it, relative to each markdown file
+    Leaves the image and all its links untouched if the move would overwrite another image
+    """
+    plan = Plan()
+    # Image source path: destination, or None for the images that stay where they are
+    destinations = {}
+    texts = read_texts(markdown_files, jobs)
+    for file_path, text in texts.items():
+        folder = os.path.dirname(file_path)
+
+        def get_new_path(match):
+            source = get_image_source(folder, match.group('path'))
+            if not source:
+                return None
+            if source not in destinations:
+                image_folder, file_name = os.path.split(source)
+                destination = os.path.join(image_folder, IMG_FOLDER, file_name)
+                if os.path.exists(destination):
+                    destination = None
+                else:
+                    plan.moves[source] = destination
+                destinations[source] = destination
+            if not destinations[source]:
+                return None
+            return os.path.relpath(destinations[source], folder).replace(os.sep, '/')
+
+        add_edit(plan, file_path, text, get_new_path)
+    return plan
+
+
+def get_canonical_path(source, file_hash, claimed):
+    """
+    Returns the path in source's sibling img folder where the unique copy of the image goes
+    Reuses a file that is already there with the same content. Adds the start of the hash
+    to the file name if another image already uses the name
+    """
+    folder, file_name = os.path.split(source)
+    name, extension = os.path.splitext(file_name)
+    for candidate_name in [file_name, '{!s}-{!s}{!s}'.format(name, file_hash[:8], extension)]:
+        candidate = os.path.join(folder, IMG_FOLDER, candidate_name)
+        if candidate in claimed:
+            if claimed[candidate] == file_hash:
+                return candidate
+            continue
+        if not os.path.exists(candidate) or get_file_hash(candidate) == file_hash:
+            return candidate
+    raise PlanError('No free name for {!s} in {!s}'.format(source, os.path.join(folder, IMG_FOLDER)))
+
+
+def plan_dedupe(markdown_files, paths, jobs=None):
+    """
+    Groups the linked images by content hash and plans to keep a single copy of each in an img folder
+    Plans to rewrite the links to point to that copy, relative to each markdown file, and to delete the other copies
+    Lists the images in paths that no link points to in the plan's orphans
+    """
+    plan = Plan()
+    texts = read_texts(markdown_files, jobs)
+    images = set()
+    for file_path, text in texts.items():
+        folder = os.path.dirname(file_path)
+        for match in RE_IMAGE.finditer(text):
+            source = resolve_image_path(folder, match.group('path'))
+            if source:
+                images.add(source)
+    images = sorted(images)
+    with ThreadPoolExecutor(max_workers=max(jobs or os.cpu_count() or 1, 1)) as executor:
+        hashes = dict(zip(images, executor.map(get_file_hash, images)))
+
+    groups = {}
+    for image in images:
+        groups.setdefault(hashes[image], []).append(image)
+
+    canonical_paths, claimed = {}, {}
+    for file_hash, group in groups.items():
+        in_img_folder = [p for p in group if is_in_img_folder(p)]
+        if in_img_folder:
+            canonical = in_img_folder[0]
+        else:
+            canonical = get_canonical_path(group[0], file_hash, claimed)
+            if not os.path.exists(canonical):
+                plan.moves[group[0]] = canonical
+        claimed[canonical] = file_hash
+        for path in group:
+            canonical_paths[path] = canonical
+    plan.deletes = [p for p in images if canonical_paths[p] != p and p not in plan.moves]
+
+    for file_path, text in texts.items():
+        folder = os.path.dirname(file_path)
+
+        def get_new_path(match):
+            source = resolve_image_path(folder, match.group('path'))
+            if not source or canonical_paths[source] == source:
+                return None
+            return os.path.relpath(canonical_paths[source], folder).replace(os.sep, '/')
+
+        add_edit(plan, file_path, text, get_new_path)
+
+    linked = set(canonical_paths.values())
+    removed = set(plan.deletes) | set(plan.moves)
+    plan.orphans = sorted(image for image in find_files(paths, IMAGE_EXTENSIONS)
+                          if image not in linked and image not in removed)
+    return plan
+
+
+def check_plan(plan):
+    """
+    Raises PlanError if the files changed since the plan was made
+    """
+    for file_path, (text, _, _) in plan.edits.items():
+        if read_text(file_path) != text:
+            raise PlanError('{!s} changed since the plan was made'.format(file_path))
+    for source, destination in plan.moves.items():
+        if not os.path.isfile(source):
+            raise PlanError('The image to move {!s} does not exist anymore'.format(source))
+        if os.path.exists(destination):
+            raise PlanError('The move destination {!s} already exists'.format(destination))
+    for path in plan.deletes:
+        if not os.path.isfile(path):
+            raise PlanError('The image to delete {!s} does not exist anymore'.format(path))
+
+
+def write_temp_file(file_path, text):
+    """
+    Writes text to a temporary file in the same folder as file_path, with the same permissions
+    Returns the temporary file's path
+    """
+    folder, file_name = os.path.split(file_path)
+    handle, temp_path = tempfile.mkstemp(prefix='.' + file_name, suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        shutil.copymode(file_path, temp_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def write_file_atomically(file_path, text):
+    """
+    Writes text to a temporary file in the same folder, then renames it to file_path
+    """
+    os.replace(write_temp_file(file_path, text), file_path)
+
+
+def apply_plan(plan):
+    """
+    Moves the images, deletes the duplicates and writes the markdown files as one transaction
+    Writes every markdown file to a temporary file before touching anything,
+    and only deletes the duplicates once every other step succeeded
+    Raises PlanError before changing anything if the files changed since the plan was made
+    If a step fails, undoes the previous steps in reverse order and raises the error
+    """
+    check_plan(plan)
+    undo = []
+    temp_paths = {}
+    trash_paths = []
+    try:
+        for file_path, (_, new_text, _) in plan.edits.items():
+            temp_paths[file_path] = write_temp_file(file_path, new_text)
+
+        for folder in sorted(set(os.path.dirname(d) for d in plan.moves.values())):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+                undo.append((os.rmdir, folder))
+        for source, destination in plan.moves.items():
+            os.rename(source, destination)
+            undo.append((os.rename, destination, source))
+        for path in plan.deletes:
+            trash_path = path + TRASH_SUFFIX
+            os.rename(path, trash_path)
+            trash_paths.append(trash_path)
+            undo.append((os.rename, trash_path, path))
+        for file_path, (text, _, _) in plan.edits.items():
+            os.replace(temp_paths[file_path], file_path)
+            del temp_paths[file_path]
+            undo.append((write_file_atomically, file_path, text))
+    except BaseException:
+        for temp_path in temp_paths.values():
+            os.remove(temp_path)
+        for action in reversed(undo):
+            try:
+                action[0](*action[1:])
+            except OSError as error:
+                print('Could not roll back {!s}: {!s}'.format(action[1], error), file=sys.stderr)
+        raise
+
+    for trash_path in trash_paths:
+        os.remove(trash_path)
+
+
+if __name__ == '__main__':
+    args = get_cli_arguments()
+    markdown_files = find_markdown_files(args.paths)
+    if not markdown_files:
+        print("No markdown files found, stopping the script")
+        sys.exit()
+
+    try:
+        if args.dedupe:
+            plan = plan_dedupe(markdown_files, args.paths, args.jobs)
+        else:
+            plan = plan_relink(markdown_files, args.jobs)
+    except PlanError as error:
+        print(error)
+        sys.exit(1)
+
+    if args.dry_run:
+        print(plan.to_json())
+        sys.exit()
 
+    if not plan.is_empty():
+        try:
+            apply_plan(plan)
+        except PlanError as error:
+            print('{!s}. Did not change any file, run the script again.'.format(error))
+            sys.exit(1)
+        except OSError as error:
+            print('{!s}. Rolled back the changes.'.format(error))
+            sys.exit(1)
 
-def get_shell_paths():
-    if len( sys.argv ) == 1:
-        return
-    shell_args = sys.argv[1:]
-    path_list = [os.path.abspath(path) for path in shell_args if os.path.exists(path)]
-    return path_list
-
-path_list = get_shell_paths()
-if not path_list:
-    path_list.append(os.path.abspath('.'))
-
-markdown_files = []
-for path in path_list:
-    if os.path.isdir(path):
-        wildcard = os.path.join(path, '*.md')
-        markdown_files.extend(glob.glob(wildcard))
-    elif path.lower().endswith('.md'):
-        markdown_files.append(path)
-if not markdown_files:
-    print("No markdown files found, stopping the script")
-    sys.exit()
-
-# Regex replace ![](foo.png) with ![](img/foo.png) and list img files to move
-RE_IMAGE = r'^\!\[(.*)\]\((?!img/)(.+)\)'
-image_files_to_move = []
-lines_changed = []
-for f in markdown_files:
-    folder, _ = os.path.split(f)
-    for line in fileinput.input(files=(f), inplace=1, backup='.bak'):
-        match = re.match(RE_IMAGE, line)
-        if match:
-            image_files_to_move.append(os.path.join(folder, match.group(2)))
-            line = match.expand(r'![\1](img/\2)')
-            lines_changed.append(line)
-        print(line.rstrip())
-
-# Move image files
-for f in image_files_to_move:
-    folder, file_name = os.path.split(f)
-    image_folder = os.path.join(folder, './img')
-    if not os.path.exists(image_folder):
-        os.mkdir(image_folder)
-    os.rename(f, os.path.join(image_folder, file_name))
+    print('Updated {!s} of {!s} markdown files, moved {!s} images and deleted {!s} duplicates'.format(
+        len(plan.edits), len(markdown_files), len(plan.moves), len(plan.deletes)))
+    if plan.orphans:
+        print('{!s} images are not linked from any markdown file:'.format(len(plan.orphans)))
+        for image in plan.orphans:
+            print('- ' + image)
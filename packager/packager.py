@@ -1,10 +1,22 @@
 """
 Collects, builds and packages all files for the course
 
-Possible improvements:
-- debug log: add an enum of stages, and allow to print messages only for a given list of steps. E.g. only pandoc commands etc.
-- debug: allow stopping execution at a given stage
-- build and debug: allow to only process a given chapter
+Builds are incremental: the CourseDatabase stores the size, modification time and content hash
+of every source file in a JSON manifest next to the _dist folder, along with the files it produced.
+On the next run, only the markdown files and img/static trees whose sources changed get rebuilt.
+The changes between the previous and the new manifest get added to _dist/CHANGELOG.md, grouped by chapter.
+Once the build succeeds, every chapter in _dist gets zipped to _dist/<chapter>.zip, if its files changed.
+With --watch, the packager keeps the project's files in memory after the build and waits for changes.
+It rebuilds the chapters that changed once a burst of saves settles. It writes the changelog, then saves the manifest
+when you stop it, so a killed session's changes get built and listed again on the next run.
+
+A run goes through stages: discover the files, diff them against the manifest, build the markdown files,
+copy the assets, write the changelog and zip the chapters. The StageReport times each stage and counts
+the files and bytes it processed. For debugging and profiling, you can:
+- print the debug messages of some stages only, e.g. only the pandoc commands with --debug markdown
+- stop after a given stage with --stop_after
+- only process some chapters with --only_chapter
+- write the timings to a JSON file with --report, and a cProfile dump of every stage with --profile
 """
 
 import os
@@ -12,22 +24,30 @@ import subprocess
 import re
 import sys
 import json
+import signal
+import argparse
+import datetime
+import time
+import cProfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from utils.copy_file_tree import copy_file_tree
+from utils.copy_file_tree import copy_file_tree, copy_file, get_file_hash, CopyMode, COPY_MODES
+from utils.zip_folder import zip_folders
+from utils.watch_folder import create_watcher
 
 # TODO: Move settings to JSON
 # TODO: Externalize utils (see https://github.com/GDquest/Blender-power-sequencer/)
-# TODO: Store file timestamps in JSON objects
-# TODO: Changelog
 
 # Settings
-RE_IGNORED_FOLDERS = r'^_?(src|draft|old|.+\.lnk|.git)$'
-re.IGNORECASE = True
-
 COURSE_FOLDER = 'course'
 EXERCISE_FOLDER = 'exercises'
 DEMO_FOLDER = 'demo'
 
+DIST_FOLDER = '_dist'
+MANIFEST_FILE = '_dist.manifest.json'
+CHANGELOG_FILE = 'CHANGELOG.md'
+
 settings = {
     "case_ignore": True,
     "folders": {
@@ -37,34 +57,159 @@ settings = {
     }
 }
 
+RE_IGNORED_FOLDERS = re.compile(r'^_?(src|draft|old|.+\.lnk|\.git)$', re.IGNORECASE if settings['case_ignore'] else 0)
+
+
+
+class Stages(Enum):
+    """The stages of a run, in order"""
+    DISCOVER = 'discover'
+    DIFF = 'diff'
+    MARKDOWN = 'markdown'
+    ASSETS = 'assets'
+    CHANGELOG = 'changelog'
+    ZIP = 'zip'
+
+
+STAGES = [member.value for member in Stages]
+
 info = {
     "processed_chapters": 0,
-    "current_step": 0,
+    "current_step": None,
 }
 
-debug = True
+# Stages to print debug messages for. Messages printed outside of a stage always show
+debug = list(Stages)
 
 
 def print_debug(*args):
-    if not debug:
+    if info['current_step'] is not None and info['current_step'] not in debug:
         return
     for arg in args:
         print(arg)
 
 
-def get_project_path():
+def format_size(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '{:.1f} {!s}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} GB'.format(size)
+
+
+class StageReport:
     """
-    Returns the course folder path to package
+    Records the wall time of every stage of a run, with the number of files and bytes it processed
+    Stages fill the 'files' and 'bytes' of the record that stage() yields, and can add other counts
+    With stop_after, sets self.stopped to True once that stage ran, so the caller skips the next ones
+    With profile_folder, profiles each stage with cProfile and writes the stats to <stage>.prof in that folder
     """
-    if len(sys.argv) == 1:
-        return
-    path = os.path.abspath(sys.argv[1])
-    if not os.path.isdir(path):
-        path = os.path.abspath('.')
-    if not os.path.isdir(path):
+    def __init__(self, stop_after=None, profile_folder=''):
+        self.stop_after = stop_after
+        self.profile_folder = profile_folder
+        self.records = []
+        self.stopped = False
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        info['current_step'] = stage
+        record = {'stage': stage.value, 'seconds': 0.0, 'files': 0, 'bytes': 0}
+        profiler = cProfile.Profile() if self.profile_folder else None
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            self.records.append(record)
+            if profiler:
+                os.makedirs(self.profile_folder, exist_ok=True)
+                record['profile'] = os.path.join(self.profile_folder, stage.value + '.prof')
+                profiler.dump_stats(record['profile'])
+            print_debug('Stage {!s}: {:.3f}s, {!s} files, {!s}'.format(
+                stage.value, record['seconds'], record['files'], format_size(record['bytes'])))
+        if stage is self.stop_after:
+            self.stopped = True
+
+    def has_run(self, stage):
+        return any(record['stage'] == stage.value for record in self.records)
+
+    def to_dict(self):
+        return {
+            'processed_chapters': info['processed_chapters'],
+            'stopped_after': self.stop_after.value if self.stopped else None,
+            'seconds': round(sum(record['seconds'] for record in self.records), 6),
+            'stages': self.records,
+        }
+
+    def save_to(self, file_path):
+        """Writes the report to a JSON file"""
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as data:
+            json.dump(self.to_dict(), data, indent=2)
+        os.replace(temp_path, file_path)
+
+
+def get_cli_arguments():
+    """
+    Returns the arguments parsed by argparse, with project_path converted to an absolute path
+    """
+    parser = argparse.ArgumentParser(description='Build and package a course from its source folder')
+    parser.add_argument('project_path', nargs='?', default='.', help='The course folder to package. Default: the current directory')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of pandoc processes and file copies to run at the same time. Default: the number of CPUs')
+    parser.add_argument('-l', '--link', choices=COPY_MODES, default=CopyMode.REFLINK.value, help='How to copy img and static files to {!s}: {!s}. reflink and hardlink fall back to a copy if the filesystem does not support them. Default: {!s}'.format(DIST_FOLDER, COPY_MODES, CopyMode.REFLINK.value))
+
+    parser.add_argument('--changelog_since', type=str, default='', help='Write the changelog against this saved manifest instead of the previous build, e.g. the manifest of the last release')
+    parser.add_argument('--no_zip', action='store_true', help='Don\'t zip the chapters after the build')
+    parser.add_argument('--force_zip', action='store_true', help='Zip every chapter again, even the ones that did not change')
+    parser.add_argument('-w', '--watch', action='store_true', help='After the build, keep watching the project and rebuild the chapters whose files change. Doesn\'t zip the chapters. Press Ctrl+C to stop')
+    parser.add_argument('--poll', action='store_true', help='With --watch, check the files for changes every second instead of using inotify')
+
+    parser.add_argument('--only_chapter', nargs='+', default=None, help='Only build and zip these chapters, by folder name')
+    parser.add_argument('--stop_after', choices=STAGES, default=None, help='Stop after this stage: {!s}. Stopping before the changelog stage leaves the manifest as is, so the next run builds and lists the same changes'.format(STAGES))
+    parser.add_argument('--debug', nargs='*', choices=STAGES, default=STAGES, help='Only print the debug messages of these stages. Pass no stage to hide all debug messages. Default: all stages')
+    parser.add_argument('--report', type=str, default='', help='Write the wall time, file count and bytes of every stage to this JSON file')
+    parser.add_argument('--profile', type=str, default='', help='Profile every stage with cProfile and write the stats to <stage>.prof files in this folder. Only profiles the main thread')
+
+    args = parser.parse_args()
+    args.project_path = os.path.abspath(args.project_path)
+    if not os.path.isdir(args.project_path):
         print('Please provide the script with a folder')
         sys.exit()
-    return path
+    if args.jobs < 1:
+        parser.error('--jobs must be 1 or more')
+    args.link = CopyMode(args.link)
+    args.stop_after = Stages(args.stop_after) if args.stop_after else None
+    args.debug = [Stages(stage) for stage in args.debug]
+    if args.only_chapter:
+        missing = [c for c in args.only_chapter if not os.path.isdir(os.path.join(args.project_path, c))]
+        if missing:
+            parser.error('--only_chapter: no chapter folder named {!s}'.format(', '.join(missing)))
+    return args
+
+
+def scan_folder(folder_path):
+    """
+    Returns the list of os.DirEntry in folder_path, or an empty list if it isn't a folder
+    """
+    try:
+        with os.scandir(folder_path) as it:
+            return list(it)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def list_tree_files(folder_path):
+    """
+    Returns the path of every file in folder_path and its subfolders
+    """
+    file_paths = []
+    for root, dirs, files in os.walk(folder_path):
+        file_paths.extend([os.path.join(root, f) for f in files])
+    return file_paths
 
 
 class Folders(Enum):
@@ -75,27 +220,64 @@ class Folders(Enum):
 
 
 class FolderProcessor:
-    """Finds files and folder paths to feed the CourseDatabase"""
-    def __init__(self, project_folder):
+    """
+    Finds files and folder paths to feed the CourseDatabase
+    Walks the project once with os.scandir. Keeps the os.DirEntry of every file it finds in self.entries
+    and the list of files of every img and static folder in self.trees, both by absolute path
+    DirEntry objects cache their stat, so the CourseDatabase doesn't stat the files again
+    If chapters is a list of chapter names, only finds the files of these chapters
+    """
+    def __init__(self, project_folder, chapters=None):
         self.project_folder = project_folder
-        self.project_chapters = [f for f in os.listdir(self.project_folder) if not re.match(RE_IGNORED_FOLDERS, f)]
+        self.chapters = chapters
+        self.entries = {}
+        self.trees = {}
+        self.project_chapters = self.find_chapters()
+
+    def find_chapters(self):
+        """Returns the names of the chapter folders in the project"""
+        return [entry.name for entry in scan_folder(self.project_folder)
+                if entry.name != DIST_FOLDER
+                and not RE_IGNORED_FOLDERS.match(entry.name)
+                and (self.chapters is None or entry.name in self.chapters)
+                and entry.is_dir()]
 
     def find_project_files(self):
         """Finds everything"""
-        project_files = []
-        for chapter_name in self.project_chapters:
-            data = {}
-            chapter_path = os.path.join(self.project_folder, chapter_name)
-
-            data['content'] = self._find_content(os.path.join(chapter_path, Folders.CONTENT.value), True)
-            data['exercises'] = self._find_content(os.path.join(chapter_path, Folders.EXERCISES.value))
-            static_path = os.path.join(chapter_path, Folders.STATIC.value)
-            if os.path.isdir(static_path):
-                data['static'] = Folders.STATIC.value
-
-            chapter_data = {chapter_name: data}
-            project_files.append(chapter_data)
-        return project_files
+        return [{chapter_name: self.find_chapter_files(chapter_name)} for chapter_name in self.project_chapters]
+
+    def find_chapter_files(self, chapter_name):
+        """Finds the files of one chapter"""
+        data = {}
+        chapter_path = os.path.join(self.project_folder, chapter_name)
+        folders = {entry.name: entry.path for entry in scan_folder(chapter_path) if entry.is_dir()}
+
+        data['content'] = self._find_content(folders.get(Folders.CONTENT.value), True)
+        # Exercises are projects to download, so we copy their files along with the built markdown files
+        data['exercises'] = self._find_content(folders.get(Folders.EXERCISES.value), True)
+        if Folders.STATIC.value in folders:
+            data['static'] = Folders.STATIC.value
+            self._find_tree_files(folders[Folders.STATIC.value])
+        return data
+
+    def refresh_chapters(self, project_files, chapter_names):
+        """
+        Forgets the files of the chapters and finds them again, e.g. after they changed on disk
+        Also picks up new chapter folders and drops the deleted ones
+        Returns the updated project files
+        """
+        prefixes = tuple(os.path.join(self.project_folder, name, '') for name in chapter_names)
+        self.entries = {path: entry for path, entry in self.entries.items() if not path.startswith(prefixes)}
+        self.trees = {path: files for path, files in self.trees.items() if not path.startswith(prefixes)}
+        self.project_chapters = self.find_chapters()
+
+        chapter_files = {}
+        for chapter in project_files:
+            chapter_files.update(chapter)
+        return [{chapter_name: self.find_chapter_files(chapter_name)
+                 if chapter_name in chapter_names or chapter_name not in chapter_files
+                 else chapter_files[chapter_name]}
+                for chapter_name in self.project_chapters]
 
     def _find_content(self, folder_path, find_static_files=False):
         """
@@ -106,115 +288,594 @@ class FolderProcessor:
             'img': [],
             'static': []
         }
-        for root, dirs, files in os.walk(folder_path):
-            dirs[:] = [d for d in dirs if not re.match(RE_IGNORED_FOLDERS, d)]
-
-            folder_relpath = os.path.relpath(root, start=folder_path)
-            found_markdown = [os.path.join(folder_relpath, f) for f in files if f.endswith('.md')]
-
-            #TODO: refactor to have file: {timestamp: ..., abspath?}
-            found['img'].extend([os.path.join(folder_relpath, folder) for folder in dirs if folder == 'img'])
-            found['markdown'].extend(found_markdown)
-            found['static'].extend([os.path.join(folder_relpath, f) for f in dirs if f != 'img'])
-
-            if find_static_files:
-                found['static'].extend([os.path.join(folder_relpath, f) for f in files if not f.endswith('.md')])
+        if not folder_path:
+            return found
+        folders = [(folder_path, '')]
+        while folders:
+            path, relpath = folders.pop()
+            for entry in scan_folder(path):
+                entry_relpath = os.path.join(relpath, entry.name)
+                if entry.is_dir():
+                    if RE_IGNORED_FOLDERS.match(entry.name):
+                        continue
+                    # img folders are copied as a whole, so we only list their files
+                    if entry.name == 'img':
+                        found['img'].append(entry_relpath)
+                        self._find_tree_files(entry.path)
+                    else:
+                        folders.append((entry.path, entry_relpath))
+                elif entry.name.endswith('.md'):
+                    found['markdown'].append(entry_relpath)
+                    self.entries[entry.path] = entry
+                elif find_static_files:
+                    found['static'].append(entry_relpath)
+                    self.entries[entry.path] = entry
         return found
 
-    def _get_timestamp(file_path):
-        try:
-            timestamp = os.path.getmtime(file_path)
-        except OSError:
-            timestamp = 0.0
-            print("Couldn't get timestamp for %s".format(file_path))
-        return timestamp
+    def _find_tree_files(self, folder_path):
+        """
+        Lists the files in folder_path and its subfolders in self.trees
+        """
+        file_paths = []
+        folders = [folder_path]
+        while folders:
+            for entry in scan_folder(folders.pop()):
+                if entry.is_dir():
+                    folders.append(entry.path)
+                else:
+                    file_paths.append(entry.path)
+                    self.entries[entry.path] = entry
+        self.trees[folder_path] = file_paths
 
 
 class CourseDatabase:
-    def __init__(self):
-        self.chapters = []
+    """
+    Stores the size, mtime and content hash of every source file in the course,
+    along with the paths of the files it produced in _dist
+    All paths are relative to the project folder
+    """
+    def __init__(self, project_folder):
+        self.project_folder = project_folder
+        self.files = {}
         self.changes = []
+        self.previous_files = {}
+        self._pending_stamps = {}
+        self._entries = {}
+        self._prefix = os.path.join(project_folder, '')
 
-    def update(self, files_dict):
+    def get_relpath(self, abs_path):
         """
-        Rebuild the database from a files dictionary
-        Use FolderProcessor to find files and get the source files_dict
-        Stamps the files and stores their paths
-        Stores it in self.data
+        Returns the path relative to the project folder
+        Strips the project folder's prefix when it can, as os.path.relpath is slow on large trees
         """
+        if abs_path.startswith(self._prefix):
+            return abs_path[len(self._prefix):]
+        return os.path.relpath(abs_path, self.project_folder)
+
+    def _get_stat(self, abs_path):
+        """Returns the stat of the FolderProcessor's DirEntry for the file, which caches it, or calls os.stat"""
+        entry = self._entries.get(abs_path)
+        return entry.stat() if entry else os.stat(abs_path)
+
+    def get_size(self, abs_path):
+        return self._get_stat(abs_path).st_size
+
+    def _stamp(self, abs_path, file_hash=None):
+        stats = self._get_stat(abs_path)
+        return {
+            'size': stats.st_size,
+            'mtime': stats.st_mtime,
+            'hash': file_hash if file_hash else get_file_hash(abs_path),
+        }
 
-        # take the FolderProcessor's result and compare it to the current DB
+    def _has_changed(self, rel_path, abs_path):
+        """
+        Compares the file on disk with its record. Only hashes the file if its size matches
+        but its mtime differs, e.g. after a git checkout
+        """
+        record = self.files.get(rel_path)
+        if not record:
+            return True
+        stats = self._get_stat(abs_path)
+        if stats.st_size != record['size']:
+            return True
+        if stats.st_mtime == record['mtime']:
+            return False
+        file_hash = get_file_hash(abs_path)
+        if file_hash != record['hash']:
+            self._pending_stamps[rel_path] = self._stamp(abs_path, file_hash)
+            return True
+        record['mtime'] = stats.st_mtime
+        return False
+
+    def update(self, source_paths, entries=None, chapters=None):
+        """
+        Compares the list of source files found by the FolderProcessor to the database
+        entries is the FolderProcessor's optional dict of path: os.DirEntry, to reuse their cached stat
+        If chapters is a list of chapter names, only the records in these chapters can be removed
+        Stores the added, modified and removed files in self.changes as (status, path) tuples
+        Returns the set of paths to rebuild and the list of records of the removed files
+        """
+        self.changes = []
+        self._pending_stamps = {}
+        self._entries = entries if entries else {}
+        changed = set()
+        found = set()
+        for abs_path in source_paths:
+            rel_path = self.get_relpath(abs_path)
+            found.add(rel_path)
+            if not self._has_changed(rel_path, abs_path):
+                continue
+            status = 'modified' if rel_path in self.files else 'added'
+            self.changes.append((status, rel_path))
+            changed.add(rel_path)
+
+        removed = []
+        missing = set(self.files) - found
+        if chapters is not None:
+            missing = set(p for p in missing if get_chapter_name(p) in chapters)
+        for rel_path in sorted(missing):
+            self.changes.append(('removed', rel_path))
+            removed.append(self.files.pop(rel_path))
+        return changed, removed
+
+    def record(self, abs_path, outputs):
+        """
+        Stamps a source file once its outputs were built successfully
+        """
+        rel_path = self.get_relpath(abs_path)
+        stamp = self._pending_stamps.pop(rel_path, None)
+        if not stamp:
+            record = self.files.get(rel_path)
+            stamp = self._stamp(abs_path, record['hash'] if record and not self._has_changed(rel_path, abs_path) else None)
+        stamp['outputs'] = [self.get_relpath(p) for p in outputs]
+        self.files[rel_path] = stamp
+
+    def outputs_exist(self, abs_path):
+        rel_path = self.get_relpath(abs_path)
+        record = self.files.get(rel_path)
+        if not record:
+            return False
+        return all(os.path.exists(os.path.join(self.project_folder, p)) for p in record['outputs'])
+
+    def write_changelog(self, file_path, previous_files=None, title=None):
+        """
+        Adds the changes between previous_files and the current files at the top of the changelog file
+        previous_files defaults to the manifest loaded with load_from
+        Returns the changes by chapter, and doesn't write anything if there are none
+        """
+        if previous_files is None:
+            previous_files = self.previous_files
+        changes = diff_manifests(previous_files, self.files)
+        if not changes:
+            return changes
+        title = title if title else datetime.date.today().isoformat()
+        text = format_changelog(changes, title)
+        if os.path.exists(file_path):
+            with open(file_path, encoding='utf-8') as changelog:
+                text += '\n' + changelog.read()
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as changelog:
+            changelog.write(text)
+        os.replace(temp_path, file_path)
+        return changes
+
+    def load_from(self, file_path):
+        """Loads the database from a JSON file, and keeps a copy of it in previous_files for the changelog"""
+        if not os.path.exists(file_path):
+            return
+        with open(file_path) as data:
+            self.files = json.loads(data.read())
+        self.previous_files = {path: dict(record) for path, record in self.files.items()}
 
-    def write_changelog():
-        pass
+    def save_to(self, file_path):
+        """Writes the database to a JSON file, replacing the previous one only once it's complete"""
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as data:
+            json.dump(self.files, data, indent=2, sort_keys=True)
+        os.replace(temp_path, file_path)
 
-    def load_from(file_path):
-        """Loads the database from a JSON file"""
-        with open(file_path) as data:
-            self.chapters = json.loads(data.read())
+
+def get_chapter_name(rel_path):
+    """Returns the chapter of a path relative to the project folder, or '' for the files at the project's root"""
+    parts = rel_path.replace(os.sep, '/').split('/', 1)
+    return parts[0] if len(parts) == 2 else ''
 
 
-project_path = get_project_path()
-processor = FolderProcessor(project_path)
-files = processor.find_project_files()
-data_json = json.dumps(files, indent=2)
-print(data_json)
-sys.exit()
+def load_manifest(file_path):
+    """Returns the files of a manifest that CourseDatabase.save_to wrote"""
+    with open(file_path) as data:
+        return json.loads(data.read())
+
+
+def diff_manifests(previous_files, current_files):
+    """
+    Compares the files of two manifests by content hash, without reading the source files
+    Returns a dict of chapter name: {'added': [], 'modified': [], 'removed': []},
+    with the paths relative to the chapter folder, for the chapters that changed
+    """
+    changes = {}
+
+    def add_change(status, rel_path):
+        chapter = get_chapter_name(rel_path)
+        path = rel_path.replace(os.sep, '/')[len(chapter) + 1:] if chapter else rel_path
+        chapter_changes = changes.setdefault(chapter, {'added': [], 'modified': [], 'removed': []})
+        chapter_changes[status].append(path)
+
+    for rel_path, record in current_files.items():
+        previous = previous_files.get(rel_path)
+        if not previous:
+            add_change('added', rel_path)
+        elif previous['hash'] != record['hash']:
+            add_change('modified', rel_path)
+    for rel_path in previous_files.keys() - current_files.keys():
+        add_change('removed', rel_path)
+    return changes
+
+
+def format_changelog(changes, title):
+    """
+    Returns a markdown changelog section from diff_manifests' changes
+    Lists the lessons, i.e. markdown files, without their extension, then the other files as assets
+    """
+    lines = ['## ' + title, '']
+    for chapter in sorted(changes):
+        lines.extend(['### ' + (chapter if chapter else 'Course'), ''])
+        for status in ['added', 'modified', 'removed']:
+            paths = sorted(changes[chapter][status])
+            lessons = [os.path.splitext(p)[0] for p in paths if p.endswith('.md')]
+            assets = [p for p in paths if not p.endswith('.md')]
+            for kind, items in [('lessons', lessons), ('assets', assets)]:
+                if not items:
+                    continue
+                lines.append('{!s} {!s}:'.format(status.capitalize(), kind))
+                lines.extend('- ' + item for item in items)
+                lines.append('')
+    return '\n'.join(lines)
+
+
+def get_build_targets(project_path, project_files, trees=None, chapters=None):
+    """
+    Returns a list of targets to build from the FolderProcessor's files.
+    Each target is a dict with a type, 'markdown', 'tree' or 'file',
+    the source and destination path and the list of source files it depends on
+    trees is the FolderProcessor's dict of folder path: file paths. Folders missing from it get listed again
+    If chapters is a list of chapter names, only returns the targets of these chapters
+    """
+    trees = trees if trees else {}
+    dist_folder = os.path.join(project_path, DIST_FOLDER)
+    targets = []
+    for chapter in project_files:
+        for chapter_name, data in chapter.items():
+            if chapters is not None and chapter_name not in chapters:
+                continue
+            chapter_path = os.path.join(project_path, chapter_name)
+            chapter_dist_path = os.path.join(dist_folder, chapter_name)
+
+            for folder in [Folders.CONTENT.value, Folders.EXERCISES.value]:
+                folder_path = os.path.join(chapter_path, folder)
+                folder_dist_path = os.path.join(chapter_dist_path, folder)
+
+                for f in data[folder]['markdown']:
+                    source = os.path.normpath(os.path.join(folder_path, f))
+                    name = os.path.splitext(os.path.basename(f))[0]
+                    targets.append({
+                        'type': 'markdown',
+                        'source': source,
+                        'destination': os.path.join(folder_dist_path, name + '.html'),
+                        'sources': [source],
+                    })
+
+                for img_folder in data[folder]['img']:
+                    source = os.path.normpath(os.path.join(folder_path, img_folder))
+                    targets.append({
+                        'type': 'tree',
+                        'source': source,
+                        'destination': os.path.join(folder_dist_path, 'img'),
+                        'sources': trees[source] if source in trees else list_tree_files(source),
+                    })
+
+                for static in data[folder]['static']:
+                    source = os.path.normpath(os.path.join(folder_path, static))
+                    targets.append({
+                        'type': 'file',
+                        'source': source,
+                        'destination': os.path.normpath(os.path.join(folder_dist_path, static)),
+                        'sources': [source],
+                    })
+
+            if 'static' in data:
+                source = os.path.join(chapter_path, data['static'])
+                targets.append({
+                    'type': 'tree',
+                    'source': source,
+                    'destination': os.path.join(chapter_dist_path, Folders.STATIC.value),
+                    'sources': trees[source] if source in trees else list_tree_files(source),
+                })
+    return targets
+
+
+def get_target_outputs(target):
+    """
+    Returns a dict of source path: list of output paths for the target
+    """
+    if target['type'] != 'tree':
+        return {target['source']: [target['destination']]}
+    return {s: [os.path.join(target['destination'], os.path.relpath(s, target['source']))]
+            for s in target['sources']}
+
+
+def remove_outputs(project_path, removed_records):
+    """
+    Deletes the files built from sources that no longer exist
+    """
+    for record in removed_records:
+        for output in record.get('outputs', []):
+            output_path = os.path.join(project_path, output)
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+                print_debug('Removed ' + output_path)
 
-def build():
-    # BUILD AND MOVE FILES WITH PANDOC
-    # Go down chapters, then folders, and in each folder there's MARKDOWN_FILES
-    folders_to_create = []
-    dist_folder = os.path.join(project_path, '_dist')
-    pandoc_build_commands = []
 
+def run_build_command(command):
+    """
+    Runs a shell command and returns a dict with the command, its exit code and stderr
+    """
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        returncode, stderr = process.returncode, process.stderr.decode('utf-8', errors='replace')
+    except OSError as error:
+        returncode, stderr = -1, str(error)
+    return {'command': command, 'returncode': returncode, 'stderr': stderr}
+
+
+def run_build_commands(commands, jobs=None):
+    """
+    Runs the commands on a pool of up to `jobs` worker threads, each waiting on its own process
+    Keeps going if a command fails and returns the results in the same order as the commands
+    """
+    if not commands:
+        return []
+    jobs = jobs or os.cpu_count() or 1
+    results = []
+    with ThreadPoolExecutor(max_workers=min(jobs, len(commands))) as executor:
+        for index, result in enumerate(executor.map(run_build_command, commands)):
+            results.append(result)
+            status = 'OK' if result['returncode'] == 0 else 'FAILED'
+            print_debug('[{!s}/{!s}] {!s} {!s}'.format(index + 1, len(commands), status, ' '.join(result['command'])))
+    return results
+
+
+def print_build_failures(failures):
+    print('{!s} files failed to build:'.format(len(failures)))
+    for result in failures:
+        print('- {!s} (exit code {!s})'.format(result['command'][1], result['returncode']))
+        for line in result['stderr'].strip().splitlines():
+            print('    ' + line)
+
+
+def build(project_path, project_files, database, jobs=None, copy_mode=CopyMode.REFLINK, trees=None, entries=None, chapters=None, report=None):
+    """
+    Builds markdown files with pandoc and copies img and static folders to _dist
+    Only processes targets with a new, modified source file, or with missing outputs
+    In img and static folders, only copies the files that differ from the ones in _dist, using copy_mode
+    Runs up to `jobs` pandoc processes or file copies at a time, defaults to the number of CPUs
+    trees and entries are the FolderProcessor's listed folders and files
+    If chapters is a list of chapter names, only builds these chapters and leaves the others' records as they are
+    Runs the diff, markdown and assets stages, recording them in report, and stops early if report says so
+    Returns the list of changes and the list of failed pandoc commands
+    """
     css_file_name = 'pandoc.css'
-    for module_name in file_paths.keys():
-        module_dist_path = os.path.join(dist_folder, module_name)
-
-        for folder in file_paths[module_name].keys():
-            folder_path = os.path.join(module_dist_path, folder)
-            folders_to_create.append(folder_path)
-
-            markdown_files = file_paths[module_name][folder][MARKDOWN_FILES]
-            for f in markdown_files:
-                markdown_folder_path, file_name = os.path.split(f)
-                name = os.path.splitext(file_name)[0]
-                export_file_name = name + '.html'
-
-                dist_path = os.path.join(folder_path, export_file_name)
-                pandoc_build_commands.append([
-                    'pandoc', f, '-t', 'html5', '--css', css_file_name, '-o',
-                    dist_path
-                ])
-
-            to_copy = file_paths[module_name][folder][FOLDERS_TO_COPY]
-            for copy_file_path in to_copy:
-                copy_file_tree(copy_file_path,
-                               os.path.join(module_dist_path, 'course', 'img'))
-                print_debug(copy_file_path)
-
-    print_debug(pandoc_build_commands[0])
-
-    # Create folders
-    for folder_path in folders_to_create:
+    report = report if report else StageReport()
+
+    with report.stage(Stages.DIFF) as record:
+        targets = get_build_targets(project_path, project_files, trees, chapters)
+        source_paths = [s for target in targets for s in target['sources']]
+        changed, removed = database.update(source_paths, entries, chapters)
+
+        def is_stale(target):
+            for source in target['sources']:
+                if database.get_relpath(source) in changed:
+                    return True
+                if not database.outputs_exist(source):
+                    return True
+            return False
+
+        stale_targets = [t for t in targets if is_stale(t)]
+        record['files'] = len(source_paths)
+        record['bytes'] = sum(database.get_size(p) for p in source_paths)
+        record['changed'] = len(database.changes)
+        print_debug('{!s}/{!s} targets to rebuild'.format(len(stale_targets), len(targets)))
+    if report.stopped:
+        return database.changes, []
+
+    for target in stale_targets:
+        folder_path = target['destination'] if target['type'] == 'tree' else os.path.dirname(target['destination'])
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
 
-    for command in pandoc_build_commands:
-        subprocess.run(command)
+    with report.stage(Stages.MARKDOWN) as record:
+        remove_outputs(project_path, removed)
+        pandoc_targets = [t for t in stale_targets if t['type'] == 'markdown']
+        pandoc_build_commands = [
+            ['pandoc', t['source'], '-t', 'html5', '--css', css_file_name, '-o', t['destination']]
+            for t in pandoc_targets
+        ]
+        results = run_build_commands(pandoc_build_commands, jobs)
+
+        failures = []
+        for target, result in zip(pandoc_targets, results):
+            if result['returncode'] != 0:
+                failures.append(result)
+                continue
+            for source, outputs in get_target_outputs(target).items():
+                database.record(source, outputs)
+            record['files'] += 1
+            record['bytes'] += os.path.getsize(target['destination'])
+        record['failed'] = len(failures)
+    if report.stopped:
+        return database.changes, failures
+
+    with report.stage(Stages.ASSETS) as record:
+        for target in stale_targets:
+            if target['type'] == 'tree':
+                copy_report = copy_file_tree(target['source'], target['destination'], jobs=jobs, mode=copy_mode)
+                print_debug('Copied {!s}: {!s} files up to date, {!s} copied, {!s} reflinked, {!s} hard-linked'.format(
+                    target['source'], copy_report['skipped'], copy_report[CopyMode.COPY], copy_report[CopyMode.REFLINK], copy_report[CopyMode.HARDLINK]))
+                record['files'] += sum(copy_report[mode] for mode in CopyMode)
+                record['bytes'] += copy_report['bytes']
+            elif target['type'] == 'file':
+                copy_file(target['source'], target['destination'], copy_mode)
+                record['files'] += 1
+                record['bytes'] += database.get_size(target['source'])
+            else:
+                continue
+            for source, outputs in get_target_outputs(target).items():
+                database.record(source, outputs)
+
+    return database.changes, failures
 
 # TODO: copy css file once per course folder
 # css_file_path = os.path.join(path, css_file_name)
 # shutil.copy(css_file_path, folder_path)
 
-# TODO timestamp files
-# Get last modified time
-# try:
-#     mtime = os.path.getmtime(file_name)
-# except OSError:
-#     mtime = 0
-# last_modified_date = datetime.fromtimestamp(mtime)
+def package_chapters(project_path, chapters, jobs=None, force=False):
+    """
+    Zips each chapter's folder in _dist to _dist/<chapter>.zip, on up to `jobs` threads
+    Skips the chapters whose files didn't change since their archive was built, unless force is True
+    Returns the list of archives it wrote
+    """
+    dist_folder = os.path.join(project_path, DIST_FOLDER)
+    folders = [(os.path.join(dist_folder, chapter), os.path.join(dist_folder, chapter + '.zip'))
+               for chapter in chapters
+               if os.path.isdir(os.path.join(dist_folder, chapter))]
+    written = []
+    for zip_path, was_written in zip_folders(folders, jobs, force):
+        print_debug('{!s} {!s}'.format('Zipped' if was_written else 'Up to date:', zip_path))
+        if was_written:
+            written.append(zip_path)
+    return written
+
 
-# TODO: For folders in _dist, if folder changed, auto ZIP
-# def has_changed_since_last_build(file_path):
+def is_ignored_by_watcher(path):
+    """Returns True for the folders the watcher shouldn't look into, and the files the packager writes"""
+    name = os.path.basename(path)
+    return name in [DIST_FOLDER, MANIFEST_FILE, MANIFEST_FILE + '.tmp'] or bool(RE_IGNORED_FOLDERS.match(name))
+
+
+def stop_on_sigterm(signal_number, frame):
+    raise KeyboardInterrupt
+
+
+def watch(project_path, processor, project_files, database, jobs=None, copy_mode=CopyMode.REFLINK, polling=False):
+    """
+    Waits for files to change in the project and rebuilds the chapters they belong to, until Ctrl+C or SIGTERM
+    Finds the files of the changed chapters again, and reuses the FolderProcessor's data for the others
+    Only updates the database in memory: the caller writes the changelog, then saves the manifest.
+    If the process gets killed, the next run builds and lists the session's changes again
+    """
+    watcher = create_watcher(project_path, is_ignored_by_watcher, polling)
+    previous_handler = signal.signal(signal.SIGTERM, stop_on_sigterm)
+    print('Watching {!s} for changes with {!s}. Press Ctrl+C to stop'.format(project_path, type(watcher).__name__))
+    try:
+        while True:
+            changed_paths = watcher.wait_for_changes()
+            info['current_step'] = None
+            if changed_paths is None:
+                print_debug('Lost track of the file changes, looking for all files again')
+                chapters = set(processor.project_chapters) | set(processor.find_chapters())
+            else:
+                # The first folder of the path is the chapter, including for chapter folders that were added or removed
+                names = set(database.get_relpath(p).replace(os.sep, '/').split('/', 1)[0] for p in changed_paths)
+                chapters = set(name for name in names
+                               if name in processor.project_chapters
+                               or os.path.isdir(os.path.join(project_path, name)))
+            if processor.chapters is not None:
+                chapters &= set(processor.chapters)
+            if not chapters:
+                continue
+            project_files = processor.refresh_chapters(project_files, chapters)
+            print('Rebuilding {!s}'.format(', '.join(sorted(chapters))))
+            changes, failures = build(project_path, project_files, database, jobs, copy_mode,
+                                      processor.trees, processor.entries, chapters)
+            print('{!s} source files changed'.format(len(changes)))
+            if failures:
+                print_build_failures(failures)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        watcher.close()
+
+
+def main(args, report):
+    """
+    Runs the stages on the project, recording them in report, and returns the exit code
+    """
+    global debug
+    debug = args.debug
+    project_path = args.project_path
+
+    with report.stage(Stages.DISCOVER) as record:
+        processor = FolderProcessor(project_path, args.only_chapter)
+        files = processor.find_project_files()
+        info['processed_chapters'] = len(processor.project_chapters)
+        # Leaves 'bytes' at 0: the files' stat is only read in the diff stage
+        record['files'] = len(processor.entries)
+        print_debug(json.dumps(files, indent=2))
+    if report.stopped:
+        return 0
+
+    manifest_path = os.path.join(project_path, MANIFEST_FILE)
+    database = CourseDatabase(project_path)
+    database.load_from(manifest_path)
+    changes, failures = build(project_path, files, database, args.jobs, args.link,
+                              processor.trees, processor.entries, args.only_chapter, report)
+    info['current_step'] = None
+    print('{!s} source files changed since the last build'.format(len(changes)))
+    # The changelog compares the saved manifest with the new one: saving the manifest
+    # before writing the changelog would lose these changes from it
+    if report.stopped:
+        if failures:
+            print_build_failures(failures)
+            return 1
+        return 0
+    if args.watch:
+        if failures:
+            print_build_failures(failures)
+        watch(project_path, processor, files, database, args.jobs, args.link, args.poll)
+
+    with report.stage(Stages.CHANGELOG) as record:
+        previous_files = load_manifest(args.changelog_since) if args.changelog_since else None
+        changelog_path = os.path.join(project_path, DIST_FOLDER, CHANGELOG_FILE)
+        chapter_changes = database.write_changelog(changelog_path, previous_files)
+        record['files'] = sum(len(paths) for c in chapter_changes.values() for paths in c.values())
+        record['bytes'] = os.path.getsize(changelog_path) if os.path.exists(changelog_path) else 0
+    info['current_step'] = None
+    database.save_to(manifest_path)
+    if chapter_changes:
+        print('Added the changes in {!s} chapters to {!s}'.format(len(chapter_changes), changelog_path))
+    if failures and not args.watch:
+        print_build_failures(failures)
+        return 1
+
+    if not args.no_zip and not args.watch and not report.stopped:
+        with report.stage(Stages.ZIP) as record:
+            archives = package_chapters(project_path, processor.project_chapters, args.jobs, args.force_zip)
+            record['files'] = len(archives)
+            record['bytes'] = sum(os.path.getsize(path) for path in archives)
+        info['current_step'] = None
+        print('{!s} chapter archives updated'.format(len(archives)))
+    return 0
+
+
+if __name__ == '__main__':
+    args = get_cli_arguments()
+    report = StageReport(args.stop_after, args.profile)
+    try:
+        exit_code = main(args, report)
+    finally:
+        if args.report:
+            report.save_to(args.report)
+            print('Wrote the stage report to {!s}'.format(args.report))
+    sys.exit(exit_code)
@@ -1,31 +1,175 @@
+"""
+Incremental, parallel copy of folder trees.
+
+copy_file_tree walks the source folder with os.scandir and skips the files whose
+destination already has the same size and modification time, or optionally the same content.
+It copies the remaining files on a pool of threads, cloning them with reflinks on
+filesystems that support it, e.g. Btrfs or XFS, or hard-linking them if you ask for it.
+"""
 import os
 import shutil
 import stat
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request of Linux's FICLONE, to share the source's data blocks with the destination
+FICLONE = 0x40049409
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class CopyMode(Enum):
+    COPY = 'copy'
+    # Copy-on-write clone when the filesystem supports it, regular copy otherwise
+    REFLINK = 'reflink'
+    # Hard link when source and destination are on the same filesystem, regular copy otherwise
+    # Editing a linked file in the destination also changes the source
+    HARDLINK = 'hardlink'
+
 
+COPY_MODES = [member.value for member in CopyMode]
 
-def copy_file_tree(src, dst, symlinks=False, ignore=None):
-    """Copy a folder and all of its content recursively"""
-    if not os.path.exists(dst):
-        os.makedirs(dst)
+
+def get_file_hash(file_path):
+    """
+    Returns the sha1 hex digest of the file's content, reading it in chunks
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def is_up_to_date(src, src_stat, dst, compare_hash=False):
+    """
+    Returns True if dst is the same file as src, or has the same size and modification time
+    With compare_hash, also returns True if dst has the same size and content but another modification time
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    if os.path.samestat(src_stat, dst_stat):
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+        return True
+    if compare_hash and get_file_hash(src) == get_file_hash(dst):
         shutil.copystat(src, dst)
-    lst = os.listdir(src)
-    if ignore:
-        excl = ignore(src, lst)
-        lst = [x for x in lst if x not in excl]
-    for item in lst:
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if symlinks and os.path.islink(s):
-            if os.path.lexists(d):
-                os.remove(d)
-            os.symlink(os.readlink(s), d)
-            try:
-                st = os.lstat(s)
-                mode = stat.S_IMODE(st.st_mode)
-                os.lchmod(d, mode)
-            except:
-                pass  # lchmod not available
-        elif os.path.isdir(s):
-            copy_file_tree(s, d, symlinks, ignore)
-        else:
-            shutil.copy2(s, d)
+        return True
+    return False
+
+
+def reflink(src, dst):
+    """
+    Clones src to dst with the FICLONE ioctl
+    Raises OSError if the platform or the filesystem doesn't support it
+    """
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, mode=CopyMode.REFLINK):
+    """
+    Copies src to dst with the given CopyMode, falling back to shutil.copy2
+    Removes dst first, so we never write through a hard link to another file
+    Returns the CopyMode that was used
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode is CopyMode.HARDLINK:
+        try:
+            os.link(src, dst)
+            return CopyMode.HARDLINK
+        except OSError:
+            pass
+    elif mode is CopyMode.REFLINK:
+        try:
+            reflink(src, dst)
+            return CopyMode.REFLINK
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+    shutil.copy2(src, dst)
+    return CopyMode.COPY
+
+
+def copy_symlink(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.symlink(os.readlink(src), dst)
+    try:
+        st = os.lstat(src)
+        mode = stat.S_IMODE(st.st_mode)
+        os.lchmod(dst, mode)
+    except (AttributeError, NotImplementedError, OSError):
+        pass  # lchmod not available
+
+
+def scan_file_tree(src, dst, symlinks=False, ignore=None):
+    """
+    Walks src with os.scandir and creates the missing folders in dst
+    Returns the lists of (src, dst, stat) files and (src, dst) symlinks to copy
+    """
+    files, links = [], []
+    folders = [(src, dst)]
+    while folders:
+        src_folder, dst_folder = folders.pop()
+        if not os.path.exists(dst_folder):
+            os.makedirs(dst_folder)
+            shutil.copystat(src_folder, dst_folder)
+        with os.scandir(src_folder) as it:
+            entries = list(it)
+        if ignore:
+            excluded = ignore(src_folder, [entry.name for entry in entries])
+            entries = [entry for entry in entries if entry.name not in excluded]
+        for entry in entries:
+            dst_path = os.path.join(dst_folder, entry.name)
+            if symlinks and entry.is_symlink():
+                links.append((entry.path, dst_path))
+            elif entry.is_dir():
+                folders.append((entry.path, dst_path))
+            else:
+                files.append((entry.path, dst_path, entry.stat()))
+    return files, links
+
+
+def copy_file_tree(src, dst, symlinks=False, ignore=None, jobs=None, mode=CopyMode.REFLINK, compare_hash=False):
+    """
+    Copy a folder and all of its content recursively
+    Skips the files that are up to date in dst and copies the others on up to `jobs` threads
+    Returns a dict with the number of files per CopyMode, plus 'skipped' for the files up to date
+    and 'bytes' for the size of the files it copied
+    """
+    files, links = scan_file_tree(src, dst, symlinks, ignore)
+    for src_path, dst_path in links:
+        copy_symlink(src_path, dst_path)
+
+    report = {member: 0 for member in CopyMode}
+    report['skipped'] = 0
+    report['bytes'] = 0
+
+    def process(file_info):
+        src_path, dst_path, src_stat = file_info
+        if is_up_to_date(src_path, src_stat, dst_path, compare_hash):
+            return 'skipped', 0
+        return copy_file(src_path, dst_path, mode), src_stat.st_size
+
+    if not files:
+        return report
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(jobs, len(files))) as executor:
+        for result, size in executor.map(process, files):
+            report[result] += 1
+            report['bytes'] += size
+    return report
@@ -0,0 +1,223 @@
+"""
+Watches a folder tree for file changes, with inotify on Linux and polling elsewhere.
+
+Both watchers have the same interface: wait_for_changes() blocks until files change,
+waits for the burst of events to settle, and returns the set of paths that changed.
+It returns None when the watcher lost track of the events and the caller should rescan everything.
+"""
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+DEFAULT_DEBOUNCE = 0.3
+DEFAULT_POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    """
+    Watches every folder of the tree with Linux's inotify, through ctypes
+    is_ignored(path) returns True for the folders not to watch, e.g. the build folder
+    Raises OSError if inotify isn't available or the system's watch limit is too low
+    """
+
+    def __init__(self, root, is_ignored=None):
+        self.root = root
+        self.is_ignored = is_ignored if is_ignored else lambda path: False
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+        try:
+            self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_folder(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not watch {!s}'.format(path))
+        self.folders[wd] = path
+
+    def _unwatch_tree(self, path):
+        prefix = os.path.join(path, '')
+        for wd, folder in list(self.folders.items()):
+            if folder == path or folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.folders[wd]
+
+    def _watch_tree(self, path):
+        """Watches the folder and its subfolders. Returns the paths of the files in them"""
+        files = []
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            try:
+                self._watch_folder(folder)
+                with os.scandir(folder) as it:
+                    entries = list(it)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not self.is_ignored(entry.path):
+                        folders.append(entry.path)
+                else:
+                    files.append(entry.path)
+        return files
+
+    def _read_events(self, timeout):
+        """
+        Returns the set of changed paths from the events available within timeout seconds,
+        None if the event queue overflowed, or an empty set if nothing happened
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, READ_SIZE)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name) if name else folder
+            if self.is_ignored(path):
+                continue
+            changed.add(path)
+            # Watches follow moved folders, so their paths would be wrong. The new path gets watched on IN_MOVED_TO
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self._unwatch_tree(path)
+            # Files created or moved in a new folder before we watch it don't send events
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                changed.update(self._watch_tree(path))
+        return changed
+
+    def wait_for_changes(self, debounce=DEFAULT_DEBOUNCE):
+        """
+        Blocks until files change, then until no event came for `debounce` seconds
+        Returns the set of changed file and folder paths, or None if some events were lost
+        """
+        changed = set()
+        while not changed:
+            changed = self._read_events(None)
+            if changed is None:
+                return None
+        while True:
+            more = self._read_events(debounce)
+            if more is None:
+                return None
+            if not more:
+                return changed
+            changed.update(more)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    """
+    Compares snapshots of the size and modification time of every file in the tree
+    is_ignored(path) returns True for the folders not to scan
+    """
+
+    def __init__(self, root, is_ignored=None, interval=DEFAULT_POLL_INTERVAL):
+        self.root = root
+        self.is_ignored = is_ignored if is_ignored else lambda path: False
+        self.interval = interval
+        self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        snapshot = {}
+        folders = [self.root]
+        while folders:
+            try:
+                with os.scandir(folders.pop()) as it:
+                    entries = list(it)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not self.is_ignored(entry.path):
+                            folders.append(entry.path)
+                        continue
+                    stats = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.path] = (stats.st_size, stats.st_mtime_ns)
+        return snapshot
+
+    def _poll(self):
+        snapshot = self._take_snapshot()
+        changed = set(path for path, stamp in snapshot.items() if self.snapshot.get(path) != stamp)
+        changed.update(self.snapshot.keys() - snapshot.keys())
+        self.snapshot = snapshot
+        return changed
+
+    def wait_for_changes(self, debounce=DEFAULT_DEBOUNCE):
+        """
+        Blocks until files change, then until a poll finds no new change
+        Returns the set of changed file paths
+        """
+        changed = set()
+        while not changed:
+            time.sleep(self.interval)
+            changed = self._poll()
+        while True:
+            time.sleep(max(debounce, self.interval))
+            more = self._poll()
+            if not more:
+                return changed
+            changed.update(more)
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, is_ignored=None, polling=False):
+    """
+    Returns an InotifyWatcher, or a PollingWatcher if polling is True or inotify isn't available
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(root, is_ignored)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, is_ignored)
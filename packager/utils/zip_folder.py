@@ -0,0 +1,109 @@
+"""
+Zips folders in parallel, only when their content changed since the last archive.
+
+Each archive stores a fingerprint of the folder in its zip comment: a hash of the path,
+size and modification time of every file. If the folder's fingerprint matches the
+archive's, we keep the archive. Files are streamed into the archive in chunks, and
+media that is already compressed gets stored as is instead of deflated.
+"""
+import os
+import hashlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+STORED_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.mp4', '.mkv', '.webm', '.mov', '.avi',
+    '.mp3', '.ogg', '.opus', '.m4a',
+    '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar',
+    '.pdf', '.woff', '.woff2',
+}
+FINGERPRINT_PREFIX = b'fingerprint:'
+
+
+def list_folder_files(folder_path):
+    """
+    Returns a sorted list of (relative path, absolute path, stat) for every file in the folder
+    """
+    files = []
+    folders = [(folder_path, '')]
+    while folders:
+        path, relpath = folders.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_relpath = relpath + '/' + entry.name if relpath else entry.name
+                if entry.is_dir():
+                    folders.append((entry.path, entry_relpath))
+                else:
+                    files.append((entry_relpath, entry.path, entry.stat()))
+    files.sort()
+    return files
+
+
+def get_fingerprint(files):
+    """
+    Returns a hash of the path, size and modification time of the files from list_folder_files
+    """
+    sha1 = hashlib.sha1()
+    for relpath, _, stats in files:
+        sha1.update('{!s}\0{!s}\0{!s}\n'.format(relpath, stats.st_size, stats.st_mtime_ns).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def read_archive_fingerprint(zip_path):
+    """
+    Returns the fingerprint stored in the archive's comment, or None
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            comment = archive.comment
+    except (OSError, zipfile.BadZipFile):
+        return None
+    if not comment.startswith(FINGERPRINT_PREFIX):
+        return None
+    return comment[len(FINGERPRINT_PREFIX):].decode('ascii')
+
+
+def get_compress_type(path):
+    extension = os.path.splitext(path)[1].lower()
+    return zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def zip_folder(folder_path, zip_path, force=False, compresslevel=6):
+    """
+    Zips the folder's content under a root folder with the same name as the folder
+    Writes to zip_path.tmp and replaces zip_path once the archive is complete
+    Skips the folder if zip_path is up to date, unless force is True
+    Returns True if it wrote the archive
+    """
+    files = list_folder_files(folder_path)
+    fingerprint = get_fingerprint(files)
+    if not force and read_archive_fingerprint(zip_path) == fingerprint:
+        return False
+
+    root = os.path.basename(os.path.normpath(folder_path))
+    temp_path = zip_path + '.tmp'
+    try:
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=compresslevel) as archive:
+            for relpath, abs_path, _ in files:
+                archive.write(abs_path, root + '/' + relpath, compress_type=get_compress_type(relpath))
+            archive.comment = FINGERPRINT_PREFIX + fingerprint.encode('ascii')
+        os.replace(temp_path, zip_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return True
+
+
+def zip_folders(folders, jobs=None, force=False):
+    """
+    Zips a list of (folder_path, zip_path) on up to `jobs` threads. zlib and file reads release the GIL
+    Returns a list of (zip_path, True if it was written), in the same order as folders
+    """
+    if not folders:
+        return []
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(jobs, len(folders))) as executor:
+        results = executor.map(lambda folder: zip_folder(folder[0], folder[1], force), folders)
+        return [(zip_path, written) for (_, zip_path), written in zip(folders, results)]